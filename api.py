@@ -5,18 +5,22 @@ move game logic to another file. Ideally the API will be simple, concerned
 primarily with communication to/from the API's users."""
 
 from protorpc import remote, messages
-from google.appengine.api import memcache
-from google.appengine.api import taskqueue
 
-from models import User, Game, Score
-from models import StringMessageForm, NewGameForm, GameForm, MakeMoveForm,\
-    ScoreForms, GameForms, GuessResultForms, UserRankForms
-from utils import get_by_urlsafe
+from models import User, Game, Score, game_etag
+from models import StringMessageForm, NewGameForm, NewGamesForm, GameForm,\
+    MakeMoveForm, MakeMovesForm, ScoreForm, ScoreForms, GameForms,\
+    GuessResultForms, UserRankForm, UserRankForms, StatsForm, StatsForms,\
+    LengthStatsForm, HintForm
+from utils import fetch_page, page_size, not_modified, mark_missing
 
-from copy import deepcopy
+import counters
+import gamecache
+import leaderboard
+import metrics
+import stats
 
 import endpoints
-import json
+import logging
 
 NEW_GAME_REQUEST = endpoints.ResourceContainer(NewGameForm)
 GET_GAME_REQUEST = endpoints.ResourceContainer(
@@ -24,10 +28,72 @@ GET_GAME_REQUEST = endpoints.ResourceContainer(
 MAKE_MOVE_REQUEST = endpoints.ResourceContainer(
     MakeMoveForm,
     urlsafe_game_key=messages.StringField(1),)
+MAKE_MOVES_REQUEST = endpoints.ResourceContainer(
+    MakeMovesForm,
+    urlsafe_game_key=messages.StringField(1),)
+NEW_GAMES_REQUEST = endpoints.ResourceContainer(NewGamesForm)
+BOT_MOVE_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    request_id=messages.StringField(2))
 USER_REQUEST = endpoints.ResourceContainer(user_name=messages.StringField(1),
                                            email=messages.StringField(2))
-
-MEMCACHE_MOVES_REMAINING = 'MOVES_REMAINING'
+PAGE_REQUEST = endpoints.ResourceContainer(
+    limit=messages.IntegerField(1, variant=messages.Variant.INT32),
+    cursor=messages.StringField(2))
+USER_PAGE_REQUEST = endpoints.ResourceContainer(
+    user_name=messages.StringField(1),
+    limit=messages.IntegerField(2, variant=messages.Variant.INT32),
+    cursor=messages.StringField(3))
+STATS_REQUEST = endpoints.ResourceContainer(
+    period=messages.StringField(1, default=stats.DAY),
+    count=messages.IntegerField(2, variant=messages.Variant.INT32,
+                                default=7))
+USER_STATS_REQUEST = endpoints.ResourceContainer(
+    user_name=messages.StringField(1),
+    period=messages.StringField(2, default=stats.DAY),
+    count=messages.IntegerField(3, variant=messages.Variant.INT32,
+                                default=7))
+
+BOARD_CURSOR_PREFIX = 'top:'
+MAX_NEW_GAMES = 500
+RECONCILE_BATCH_SIZE = 500
+
+
+def _leaderboard_page(request, board, query):
+    """Returns one page of a ranked list as a tuple of (board entries,
+    entities, next_cursor). Pages inside the precomputed top-N board are
+    served from its entries; pages past it continue from the datastore query
+    with ordinary cursors."""
+    cursor = request.cursor
+    if cursor and not cursor.startswith(BOARD_CURSOR_PREFIX):
+        entities, next_cursor = fetch_page(query, request.limit, cursor)
+        return [], entities, next_cursor
+    limit = page_size(request.limit)
+    entries = leaderboard.get_board(board)
+    if entries is None:
+        # the board has not been built yet, so fall back to the query
+        entities, next_cursor = fetch_page(query, limit)
+        return [], entities, next_cursor
+
+    offset = 0
+    if cursor:
+        try:
+            offset = int(cursor[len(BOARD_CURSOR_PREFIX):])
+        except ValueError:
+            raise endpoints.BadRequestException('Invalid cursor')
+    board_full = len(entries) >= leaderboard.TOP_N
+    if offset < len(entries):
+        page = entries[offset:offset + limit]
+        next_offset = offset + len(page)
+        next_cursor = None
+        if next_offset < len(entries) or board_full:
+            next_cursor = BOARD_CURSOR_PREFIX + str(next_offset)
+        return page, [], next_cursor
+    if not board_full:
+        return [], [], None
+    # past the board: skip its entries once, then continue with cursors
+    entities, next_cursor = fetch_page(query, limit, offset=offset)
+    return [], entities, next_cursor
 
 
 @endpoints.api(name='hangman', version='v1')
@@ -38,13 +104,12 @@ class HangmanApi(remote.Service):
                       path='user',
                       name='create_user',
                       http_method='POST')
+    @metrics.instrumented
     def create_user(self, request):
         """Create a User. Requires a unique username"""
-        if User.query(User.name == request.user_name).get():
+        if not User.create(request.user_name, request.email):
             raise endpoints.ConflictException(
                     'A User with that name already exists!')
-        user = User(name=request.user_name, email=request.email)
-        user.put()
         return StringMessageForm(message='User {} created!'.format(
                 request.user_name))
 
@@ -53,32 +118,64 @@ class HangmanApi(remote.Service):
                       path='game',
                       name='new_game',
                       http_method='POST')
+    @metrics.instrumented
     def new_game(self, request):
         """Creates new game"""
-        user = User.query(User.name == request.user_name).get()
+        user = User.get_by_name(request.user_name)
         if not user:
             raise endpoints.NotFoundException(
                     'A User with that name does not exist!')
         try:
-            game = Game.new_game(user.key, request.number_of_letters,
-                                 request.attempts)
+            game = Game.new_game(user, request.number_of_letters,
+                                 request.attempts, request.difficulty)
         except ValueError as e:
             raise endpoints.BadRequestException(e)
-
-        # Use a task queue to update the average attempts remaining.
-        # This operation is not needed to complete the creation of a new game
-        # so it is performed out of sequence.
-        taskqueue.add(url='/tasks/cache_average_attempts')
         return game.to_form()
 
+    @endpoints.method(request_message=NEW_GAMES_REQUEST,
+                      response_message=GameForms,
+                      path='games',
+                      name='new_games',
+                      http_method='POST')
+    @metrics.instrumented
+    def new_games(self, request):
+        """Creates games_per_user new games for each of the given users"""
+        if not request.user_names:
+            raise endpoints.BadRequestException('No user names given.')
+        if request.games_per_user < 1:
+            raise endpoints.BadRequestException(
+                'Number of games must be a positive number.')
+        if len(request.user_names) * request.games_per_user > MAX_NEW_GAMES:
+            raise endpoints.BadRequestException(
+                'At most {} games can be created at once.'.format(
+                    MAX_NEW_GAMES))
+        users = User.get_by_names(request.user_names)
+        missing = [name for name, user in zip(request.user_names, users)
+                   if not user]
+        if missing:
+            raise endpoints.NotFoundException(
+                'No User exists with the name(s): {}'.format(
+                    ', '.join(missing)))
+        try:
+            games = Game.new_games(users * request.games_per_user,
+                                   request.number_of_letters,
+                                   request.attempts, request.difficulty)
+        except ValueError as e:
+            raise endpoints.BadRequestException(e)
+        return Game.to_forms(games)
+
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=GameForm,
                       path='game/{urlsafe_game_key}',
                       name='get_game',
                       http_method='GET')
+    @metrics.instrumented
     def get_game(self, request):
-        """Return the current game state."""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        """Return the current game state. Answers If-None-Match with
+        not modified, from the cached version, while the game is unchanged"""
+        game, etag = self._get_game_if_modified(request.urlsafe_game_key)
+        if etag:
+            return GameForm(etag=etag, not_modified=True)
         if game:
             return game.to_form()
         else:
@@ -89,173 +186,409 @@ class HangmanApi(remote.Service):
                       path='game/{urlsafe_game_key}',
                       name='make_move',
                       http_method='PUT')
+    @metrics.instrumented
     def make_move(self, request):
-        """Makes a move. Returns a game state with message."""
-        # make sure the game is still on
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        if game.game_over:
-            raise endpoints.BadRequestException('Game already over.')
-        # format the guess correctly before using it for matching
-        formatted_guess = request.guess.strip().lower()
+        """Makes a move. Returns a game state with message. A retried request
+        with the same request_id returns the stored result instead of making
+        the move again."""
+        return self._make_move(request.urlsafe_game_key, request.request_id,
+                               lambda game: request.guess)
 
-        # make sure the guess does not contain any special characters
-        if not formatted_guess.isalpha():
-            raise endpoints.BadRequestException(
-                'Your guess can only contain alphabet letters.')
-        # make sure the guess is of an appropriate length
-        if len(formatted_guess) not in (1, len(game.word)):
-            raise endpoints.BadRequestException(
-                'Your guess must either be a single letter, or a guess for the entire word.')  # noqa
-        # make sure the user has not guessed this already
-        if game.all_results:
-            for result in game.all_results:
-                if formatted_guess == (json.loads(result))['guess']:
-                    raise endpoints.BadRequestException(
-                        'You already guessed that!')
-
-        result = {'guess': formatted_guess}
-        # if the user guesses the whole word right, they win
-        if formatted_guess == game.word:
-            result['hit'] = True
-            game.end_game(True)
-
-        # if the user guesses a single letter, and they're right
-        if formatted_guess in game.word:
-            result['hit'] = True
-            letter_pos = [pos for pos, letter in enumerate(game.word)
-                          if letter == formatted_guess]
-            for x in letter_pos:
-                game.reveal[x] = formatted_guess
-        # if they user guesses a single letter, and they're wrong
-        if formatted_guess not in game.word:
-            game.attempts_remaining -= 1
-            result['hit'] = False
-
-        # if the user has no more attempts remaining, they lose
-        if game.attempts_remaining < 1:
-            game.end_game(False)
-
-        # add guess results to game history, committ changes,
-        # return gameform representation of game state
-        result['word'] = deepcopy(game.reveal)
-        game.all_results.append(json.dumps(result))
-        game.put()
+    @endpoints.method(request_message=BOT_MOVE_REQUEST,
+                      response_message=GameForm,
+                      path='game/{urlsafe_game_key}/bot',
+                      name='make_bot_move',
+                      http_method='PUT')
+    @metrics.instrumented
+    def make_bot_move(self, request):
+        """Lets the bot make the next move, using the same suggestion as
+        get_hint. Returns a game state with message."""
+        def _guess(game):
+            guess, _ = game.hint()
+            if guess is None:
+                raise endpoints.BadRequestException('No guesses left.')
+            return guess
+        return self._make_move(request.urlsafe_game_key, request.request_id,
+                               _guess)
+
+    def _make_move(self, urlsafe_game_key, request_id, choose_guess):
+        """Makes the move returned by choose_guess(game) and returns a game
+        state with message"""
+        def _move(game):
+            replayed = request_id and game.receipt(request_id)
+            if replayed:
+                return replayed[0], True
+            # make sure the game is still on
+            if game.game_over:
+                raise endpoints.BadRequestException('Game already over.')
+            try:
+                return game.make_guess(choose_guess(game), request_id), False
+            except ValueError as e:
+                raise endpoints.BadRequestException(e)
+
+        try:
+            moved, game = gamecache.update_game(urlsafe_game_key, _move)
+        except gamecache.ConcurrentMoveError as e:
+            raise endpoints.ConflictException(e)
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        result, replayed = moved
+        if not replayed and not result['hit'] and not game.game_over:
+            counters.increment({counters.ACTIVE_ATTEMPTS_REMAINING: -1})
         return game.to_form(result)
 
-    @endpoints.method(response_message=ScoreForms,
+    @endpoints.method(request_message=MAKE_MOVES_REQUEST,
+                      response_message=GuessResultForms,
+                      path='game/{urlsafe_game_key}/moves',
+                      name='make_moves',
+                      http_method='PUT')
+    @metrics.instrumented
+    def make_moves(self, request):
+        """Makes several moves in order, stopping if the game ends. Returns
+        the result of each move made. If any guess is invalid, none of the
+        moves are made. A retried request with the same request_id returns
+        the stored results instead of making the moves again."""
+        if not request.guesses:
+            raise endpoints.BadRequestException('No guesses given.')
+
+        def _moves(game):
+            replayed = request.request_id and game.receipt(request.request_id)
+            if replayed:
+                return replayed, True
+            results = []
+            for guess in request.guesses:
+                # make sure the game is still on
+                if game.game_over:
+                    if results:
+                        break
+                    raise endpoints.BadRequestException('Game already over.')
+                try:
+                    results.append(game.make_guess(guess,
+                                                   request.request_id))
+                except ValueError as e:
+                    raise endpoints.BadRequestException(e)
+            return results, False
+
+        try:
+            moved, game = gamecache.update_game(request.urlsafe_game_key,
+                                                _moves)
+        except gamecache.ConcurrentMoveError as e:
+            raise endpoints.ConflictException(e)
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        results, replayed = moved
+        if not replayed:
+            # a miss that ended the game was counted by end_game
+            misses = len([result for result in results
+                          if not result['hit']])
+            if game.game_over and not results[-1]['hit']:
+                misses -= 1
+            counters.increment({counters.ACTIVE_ATTEMPTS_REMAINING: -misses})
+        return GuessResultForms(
+            items=[Game.result_to_form(result) for result in results])
+
+    @endpoints.method(request_message=PAGE_REQUEST,
+                      response_message=ScoreForms,
                       path='scores',
                       name='get_scores',
                       http_method='GET')
+    @metrics.instrumented
     def get_scores(self, request):
-        """Return all scores"""
-        return ScoreForms(items=[score.to_form() for score in Score.query()])
-
-    @endpoints.method(request_message=USER_REQUEST,
+        """Return a page of scores"""
+        scores, next_cursor = fetch_page(Score.query(), request.limit,
+                                         request.cursor)
+        forms = Score.to_forms(scores)
+        forms.next_cursor = next_cursor
+        return forms
+
+    @endpoints.method(request_message=USER_PAGE_REQUEST,
                       response_message=ScoreForms,
                       path='scores/user/{user_name}',
                       name='get_user_scores',
                       http_method='GET')
+    @metrics.instrumented
     def get_user_scores(self, request):
-        """Returns all of an individual User's scores"""
-        user = User.query(User.name == request.user_name).get()
+        """Returns a page of an individual User's scores"""
+        user = User.get_by_name(request.user_name)
         if not user:
             raise endpoints.NotFoundException(
                     'A User with that name does not exist!')
-        scores = Score.query(Score.user == user.key)
-        return ScoreForms(items=[score.to_form() for score in scores])
+        scores, next_cursor = fetch_page(Score.query_for_user(user.key),
+                                         request.limit, request.cursor)
+        forms = Score.to_forms(scores)
+        forms.next_cursor = next_cursor
+        return forms
 
     @endpoints.method(response_message=StringMessageForm,
                       path='games/average_attempts',
                       name='get_average_attempts_remaining',
                       http_method='GET')
+    @metrics.instrumented
     def get_average_attempts(self, request):
-        """Get the cached average moves remaining"""
-        return StringMessageForm(
-            message=memcache.get(MEMCACHE_MOVES_REMAINING) or '')
+        """Get the average moves remaining from the active game counters"""
+        totals = counters.get_counts([counters.ACTIVE_GAMES,
+                                      counters.ACTIVE_ATTEMPTS_REMAINING])
+        message = ''
+        if totals[counters.ACTIVE_GAMES] > 0:
+            average = (float(totals[counters.ACTIVE_ATTEMPTS_REMAINING]) /
+                       totals[counters.ACTIVE_GAMES])
+            message = 'The average moves remaining is {:.2f}'.format(average)
+        return StringMessageForm(message=message)
 
     @endpoints.method(request_message=USER_REQUEST,
                       response_message=GameForms,
                       path='games/user/{user_name}',
                       name='get_user_games',
                       http_method='GET')
+    @metrics.instrumented
     def get_user_games(self, request):
         """ Gets all of a user's active games"""
-        # TODO: make all games descendants of a user
-
-        user = User.query(User.name == request.user_name).get()
+        user = User.get_by_name(request.user_name)
         if not user:
             raise endpoints.NotFoundException(
                     'A User with that name does not exist!')
-        games = Game.query(Game.user == user.key, Game.game_over == False)  # noqa
+        games = Game.query_for_user(user.key).filter(
+            Game.game_over == False)  # noqa
 
-        return GameForms(items=[game.to_form() for game in games])
+        return Game.to_forms(gamecache.with_cached(games.fetch()))
 
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=StringMessageForm,
                       path='cancel/game/{urlsafe_game_key}',
                       name='cancel_game',
                       http_method='DELETE')
+    @metrics.instrumented
     def cancel_game(self, request):
         """Cancels in progress games"""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        game = gamecache.get_game(request.urlsafe_game_key)
         if not game:
             raise endpoints.NotFoundException('Game not found!')
         if game.game_over:
             raise endpoints.BadRequestException(
                 'Completed games cannot be cancelled')
         game.key.delete()
+        gamecache.forget_game(game.key.urlsafe())
+        # polls of the cancelled game are answered from memcache
+        mark_missing(set([request.urlsafe_game_key, game.key.urlsafe()]))
+        counters.increment({
+            counters.ACTIVE_GAMES: -1,
+            counters.ACTIVE_ATTEMPTS_REMAINING: -game.attempts_remaining})
 
         return StringMessageForm(message='Game successfully cancelled.')
 
-    @endpoints.method(response_message=ScoreForms,
+    @endpoints.method(request_message=PAGE_REQUEST,
+                      response_message=ScoreForms,
                       path='high_scores',
                       name='get_high_scores',
                       http_method='GET')
+    @metrics.instrumented
     def get_high_scores(self, request):
-        """returns a list of high scores"""
-        scores = Score.query().order(-Score.attempts_remaining,
-                                     -Score.number_of_letters)
-        return ScoreForms(items=[score.to_form() for score in scores])
-
-    @endpoints.method(response_message=UserRankForms,
+        """returns a page of high scores. Pages within the leaderboard answer
+        If-None-Match with not modified while the leaderboard is unchanged"""
+        etag = None
+        if (not request.cursor or
+                request.cursor.startswith(BOARD_CURSOR_PREFIX)):
+            etag = '"{}:{}:{}"'.format(leaderboard.get_version(),
+                                       request.cursor or '', request.limit)
+            if not_modified(self.request_state, etag):
+                return ScoreForms(etag=etag, not_modified=True)
+        query = Score.query().order(-Score.attempts_remaining,
+                                    -Score.number_of_letters)
+        entries, scores, next_cursor = _leaderboard_page(
+            request, leaderboard.HIGH_SCORES, query)
+        forms = Score.to_forms(scores)
+        forms.items.extend(self._score_entry_to_form(entry)
+                           for entry in entries)
+        forms.next_cursor = next_cursor
+        forms.etag = etag
+        return forms
+
+    @endpoints.method(request_message=PAGE_REQUEST,
+                      response_message=UserRankForms,
                       path='user_rankings',
                       name='get_user_rankings',
                       http_method='GET')
+    @metrics.instrumented
     def get_user_rankings(self, request):
-        """returns all users ranked by performance"""
-        users = User.query().order(-User.wins,
+        """returns a page of users ranked by performance"""
+        query = User.query().order(-User.wins,
                                    -User.avg_attempts_remaining)
-        return UserRankForms(items=[user.rank_to_form() for user in users])
+        entries, users, next_cursor = _leaderboard_page(
+            request, leaderboard.USER_RANKINGS, query)
+        items = [self._user_entry_to_form(entry) for entry in entries]
+        items.extend(user.rank_to_form() for user in users)
+        return UserRankForms(items=items, next_cursor=next_cursor)
+
+    @endpoints.method(request_message=USER_REQUEST,
+                      response_message=UserRankForm,
+                      path='user_rankings/{user_name}',
+                      name='get_user_rank',
+                      http_method='GET')
+    @metrics.instrumented
+    def get_user_rank(self, request):
+        """returns a user's rank information, including their position"""
+        user = User.get_by_name(request.user_name)
+        if not user:
+            raise endpoints.NotFoundException(
+                    'A User with that name does not exist!')
+        form = user.rank_to_form()
+        if user.wins is None:
+            return form
+        # count the users in better buckets, then only scan the user's own
+        # bucket for those with a higher wins ratio
+        bucket = leaderboard.bucket_for(user.wins)
+        query = User.query(User.wins > user.wins)
+        upper = leaderboard.bucket_upper_bound(bucket)
+        if upper is not None:
+            query = query.filter(User.wins < upper)
+        form.rank = (leaderboard.users_above_bucket(bucket) +
+                     query.count() + 1)
+        return form
+
+    @endpoints.method(request_message=GET_GAME_REQUEST,
+                      response_message=HintForm,
+                      path='game/{urlsafe_game_key}/hint',
+                      name='get_hint',
+                      http_method='GET')
+    @metrics.instrumented
+    def get_hint(self, request):
+        """Suggests the next guess for a game, with the number of words that
+        still fit it"""
+        game = gamecache.get_game(request.urlsafe_game_key)
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        if game.game_over:
+            raise endpoints.BadRequestException('Game already over.')
+        guess, candidates = game.hint()
+        if guess is None:
+            raise endpoints.BadRequestException('No guesses left.')
+        return HintForm(guess=guess, candidates=candidates)
 
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=GuessResultForms,
                       path='history/{urlsafe_game_key}',
                       name='get_game_history',
                       http_method='GET')
+    @metrics.instrumented
     def get_game_history(self, request):
-        """Get game history"""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        """Get game history. Answers If-None-Match with not modified, from
+        the cached version, while the game is unchanged"""
+        game, etag = self._get_game_if_modified(request.urlsafe_game_key)
+        if etag:
+            return GuessResultForms(etag=etag, not_modified=True)
         if not game:
             raise endpoints.NotFoundException('Game not found!')
-        if not game.all_results:
+        history = game.history()
+        if not history:
             raise endpoints.NotFoundException('Game history not found!')
 
         return GuessResultForms(
-            items=[Game.result_to_form(json.loads(result))
-                   for result in game.all_results])
+            items=[Game.result_to_form(result) for result in history],
+            etag=game.etag())
+
+    def _get_game_if_modified(self, urlsafe):
+        """Returns a tuple of the game for a conditional read, or None, and
+        the client's ETag if it is still current, in which case the game is
+        not loaded"""
+        version = gamecache.get_version(urlsafe)
+        if version is not None:
+            etag = game_etag(version)
+            if not_modified(self.request_state, etag):
+                return None, etag
+        game = gamecache.get_game(urlsafe)
+        if game and not_modified(self.request_state, game.etag()):
+            return game, game.etag()
+        return game, None
+
+    @endpoints.method(request_message=STATS_REQUEST,
+                      response_message=StatsForms,
+                      path='stats',
+                      name='get_stats',
+                      http_method='GET')
+    @metrics.instrumented
+    def get_stats(self, request):
+        """Returns daily or weekly stats of all finished games"""
+        return self._stats_to_forms(request, None)
+
+    @endpoints.method(request_message=USER_STATS_REQUEST,
+                      response_message=StatsForms,
+                      path='stats/user/{user_name}',
+                      name='get_user_stats',
+                      http_method='GET')
+    @metrics.instrumented
+    def get_user_stats(self, request):
+        """Returns daily or weekly stats of a User's finished games"""
+        user = User.get_by_name(request.user_name)
+        if not user:
+            raise endpoints.NotFoundException(
+                    'A User with that name does not exist!')
+        return self._stats_to_forms(request, user.key)
+
+    @staticmethod
+    def _stats_to_forms(request, user_key):
+        """Returns the StatsForms of the requested time series"""
+        if request.period not in stats.PERIODS:
+            raise endpoints.BadRequestException(
+                'Period can only be {}!'.format(', '.join(stats.PERIODS)))
+        if not 0 < request.count <= stats.MAX_PERIODS:
+            raise endpoints.BadRequestException(
+                'Count must be between 1 and {}!'.format(stats.MAX_PERIODS))
+        forms = StatsForms(period=request.period)
+        for start, rollup in stats.get_series(request.period, request.count,
+                                              user_key):
+            form = StatsForm(start=start.isoformat(),
+                             games_played=rollup.games_played,
+                             games_won=rollup.games_won)
+            if rollup.games_played:
+                form.win_rate = rollup.games_won / float(rollup.games_played)
+                form.avg_attempts_remaining = (
+                    rollup.total_attempts_remaining / rollup.games_played)
+            for length, totals in sorted((rollup.by_length or {}).items(),
+                                         key=lambda item: int(item[0])):
+                form.by_length.append(LengthStatsForm(
+                    number_of_letters=int(length), games_played=totals[0],
+                    games_won=totals[1],
+                    avg_attempts_remaining=totals[2] / totals[0]))
+            forms.items.append(form)
+        return forms
+
+    @staticmethod
+    def _score_entry_to_form(entry):
+        """Returns a ScoreForm for a high score board entry"""
+        attempts_remaining, number_of_letters, user_name, won, date = entry
+        return ScoreForm(user_name=user_name, won=won, date=date,
+                         number_of_letters=number_of_letters,
+                         attempts_remaining=attempts_remaining)
+
+    @staticmethod
+    def _user_entry_to_form(entry):
+        """Returns a UserRankForm for a user rankings board entry"""
+        wins, avg_attempts_remaining, user_name = entry
+        return UserRankForm(user_name=user_name, wins=wins,
+                            avg_attempts_remaining=avg_attempts_remaining)
 
     @staticmethod
-    def _cache_average_attempts():
-        """Populates memcache with the average moves remaining of Games"""
-        games = Game.query(Game.game_over == False).fetch()  # noqa
-        if games:
-            count = len(games)
-            total_attempts_remaining = sum([game.attempts_remaining
-                                            for game in games])
-            average = float(total_attempts_remaining)/count
-            memcache.set(MEMCACHE_MOVES_REMAINING,
-                         'The average moves remaining is {:.2f}'
-                         .format(average))
+    def _reconcile_average_attempts():
+        """Recounts active Games and their attempts remaining with a full
+        scan, and resets the sharded counters if they have drifted"""
+        count = 0
+        total_attempts_remaining = 0
+        query = Game.query(Game.game_over == False)  # noqa
+        cursor, more = None, True
+        while more:
+            games, cursor, more = query.fetch_page(RECONCILE_BATCH_SIZE,
+                                                   start_cursor=cursor)
+            # the stored copies can be behind the cached ones
+            for game in gamecache.with_cached(games):
+                count += 1
+                total_attempts_remaining += game.attempts_remaining
+        totals = {counters.ACTIVE_GAMES: count,
+                  counters.ACTIVE_ATTEMPTS_REMAINING: total_attempts_remaining}
+        current = counters.get_counts(totals.keys())
+        if current != totals:
+            logging.warning('Active game counters drifted: %s, expected %s',
+                            current, totals)
+            counters.reset(totals)
 
 
 api = endpoints.api_server([HangmanApi])
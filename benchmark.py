@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+"""benchmark.py - Local benchmark and load simulation for the Hangman API.
+
+Runs HangmanApi in-process against the App Engine testbed datastore,
+memcache and taskqueue stubs. Simulated players create an account, play
+full games with a letter frequency guessing strategy, and read their game
+history and the leaderboards. Reports throughput, per-endpoint latency
+percentiles and mean RPC counts, and can save the results as a baseline or
+check them against one:
+
+    python benchmark.py --sdk ~/google-cloud-sdk/platform/google_appengine \\
+        --users 100 --games 10 --save-baseline bench_baseline.json
+    python benchmark.py --sdk ... --baseline bench_baseline.json
+
+The check fails (exit status 1) if any endpoint's p95 latency or mean RPC
+count exceeds the baseline by more than the tolerance."""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+# letters in rough order of how often they appear in English words
+LETTER_FREQUENCY = 'etaoinsrhldcumfpgwybvkxjqz'
+
+
+def _setup_sdk(sdk_path):
+    """Puts the App Engine SDK and its bundled libraries on sys.path"""
+    if sdk_path:
+        sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def _activate_testbed():
+    """Activates the service stubs. This must happen before the app modules
+    are imported, because metrics.py attaches its RPC hooks to the API proxy
+    that is active at import time"""
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+
+    bed = testbed.Testbed()
+    bed.activate()
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+        probability=1)
+    bed.init_datastore_v3_stub(consistency_policy=policy)
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=os.path.dirname(
+        os.path.abspath(__file__)))
+    bed.init_app_identity_stub()
+    bed.init_mail_stub()
+    return bed
+
+
+class Recorder(object):
+    """Collects the latency and RPC counts of every endpoint call"""
+
+    def __init__(self, service, metrics):
+        self.service = service
+        self.metrics = metrics
+        self.calls = {}
+
+    def call(self, name, container, **fields):
+        """Calls an endpoints method with a request built from fields"""
+        request = container.combined_message_class(**fields)
+        method = getattr(self.service, name)
+        with self.metrics.collect() as stats:
+            start = time.time()
+            try:
+                return method(request)
+            finally:
+                elapsed_ms = (time.time() - start) * 1000
+                self.calls.setdefault(name, []).append(
+                    (elapsed_ms, dict(stats)))
+
+    def summary(self):
+        """Returns latency percentiles and mean RPC counts per endpoint"""
+        result = {}
+        for name, calls in sorted(self.calls.items()):
+            latencies = sorted(latency for latency, _ in calls)
+            endpoint = {
+                'calls': len(calls),
+                'p50_ms': _percentile(latencies, 0.50),
+                'p95_ms': _percentile(latencies, 0.95),
+                'p99_ms': _percentile(latencies, 0.99),
+                'max_ms': round(latencies[-1], 2),
+            }
+            for counter in self.metrics.COUNTERS:
+                total = sum(stats[counter] for _, stats in calls)
+                endpoint['mean_' + counter] = round(
+                    float(total) / len(calls), 2)
+            result[name] = endpoint
+        return result
+
+
+def _percentile(values, fraction):
+    index = min(int(fraction * len(values)), len(values) - 1)
+    return round(values[index], 2)
+
+
+def play_game(recorder, api, user_name, number_of_letters):
+    """Plays one game to the end, guessing letters by frequency"""
+    game = recorder.call('new_game', api.NEW_GAME_REQUEST,
+                         user_name=user_name,
+                         number_of_letters=number_of_letters, attempts=6)
+    key = game.urlsafe_key
+    for letter in LETTER_FREQUENCY:
+        form = recorder.call('make_move', api.MAKE_MOVE_REQUEST,
+                             urlsafe_game_key=key, guess=letter)
+        if form.game_over:
+            break
+        # guess the word once every letter has been revealed
+        if all(form.result.word):
+            recorder.call('make_move', api.MAKE_MOVE_REQUEST,
+                          urlsafe_game_key=key,
+                          guess=''.join(form.result.word))
+            break
+    recorder.call('get_game_history', api.GET_GAME_REQUEST,
+                  urlsafe_game_key=key)
+
+
+def run(args):
+    _setup_sdk(args.sdk)
+    bed = _activate_testbed()
+    try:
+        import api
+        import metrics
+        import words
+        # the recorder measures every call itself
+        metrics.SAMPLE_RATE = 0
+
+        random.seed(args.seed)
+        lengths = words.get_store().lengths()
+        recorder = Recorder(api.HangmanApi(), metrics)
+        start = time.time()
+        user_names = ['player{}'.format(index) for index in range(args.users)]
+        for user_name in user_names:
+            recorder.call('create_user', api.USER_REQUEST,
+                          user_name=user_name)
+        for _ in range(args.games):
+            for user_name in user_names:
+                play_game(recorder, api, user_name, random.choice(lengths))
+            recorder.call('get_high_scores', api.PAGE_REQUEST)
+            recorder.call('get_user_rankings', api.PAGE_REQUEST)
+        elapsed = time.time() - start
+    finally:
+        bed.deactivate()
+
+    requests = sum(len(calls) for calls in recorder.calls.values())
+    return {
+        'users': args.users,
+        'games_per_user': args.games,
+        'seconds': round(elapsed, 2),
+        'games_per_second': round(args.users * args.games / elapsed, 2),
+        'requests_per_second': round(requests / elapsed, 2),
+        'endpoints': recorder.summary(),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Returns a list of regressions of results against baseline"""
+    regressions = []
+    for name, base in baseline['endpoints'].items():
+        current = results['endpoints'].get(name)
+        if not current:
+            continue
+        fields = ['p95_ms'] + [field for field in base
+                               if field.startswith('mean_')]
+        for field in fields:
+            allowed = base[field] * (1 + tolerance)
+            # allow for noise around very small values
+            if (current.get(field, 0) > allowed and
+                    current.get(field, 0) - base[field] > 0.5):
+                regressions.append('{} {}: {} (baseline {})'.format(
+                    name, field, current[field], base[field]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sdk', default=os.environ.get('GAE_SDK'),
+                        help='path to the App Engine Python SDK')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--games', type=int, default=10,
+                        help='games played by each user')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save-baseline', metavar='PATH',
+                        help='save the results as a baseline file')
+    parser.add_argument('--baseline', metavar='PATH',
+                        help='fail if the results regress from this baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed fractional regression (default 0.2)')
+    args = parser.parse_args()
+
+    results = run(args)
+    print(json.dumps(results, indent=2, sort_keys=True))
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file),
+                                  args.tolerance)
+        if regressions:
+            print('FAIL\n' + '\n'.join(regressions))
+            sys.exit(1)
+        print('PASS')
+
+
+if __name__ == '__main__':
+    main()
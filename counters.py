@@ -0,0 +1,103 @@
+"""counters.py - Sharded counters for running totals that change too often
+to keep in a single entity. Each counter is split over NUM_SHARDS entities,
+updated by delta on a random shard, and its total is cached in memcache."""
+
+import random
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+ACTIVE_GAMES = 'active_games'
+ACTIVE_ATTEMPTS_REMAINING = 'active_attempts_remaining'
+
+NUM_SHARDS = 20
+MEMCACHE_COUNTER = 'COUNTER:{}'
+COUNTER_CACHE_SECONDS = 60
+
+
+class CounterShard(ndb.Model):
+    """One shard of a named counter"""
+    count = ndb.IntegerProperty(default=0, indexed=False)
+
+
+def _shard_key(name, index):
+    return ndb.Key(CounterShard, '{}-{}'.format(name, index))
+
+
+def _shard_keys(name):
+    return [_shard_key(name, index) for index in range(NUM_SHARDS)]
+
+
+def get_counts(names):
+    """Returns a dict of the totals of the named counters, read from
+    memcache with a fallback to summing the datastore shards"""
+    cache_keys = dict((MEMCACHE_COUNTER.format(name), name) for name in names)
+    cached = memcache.get_multi(cache_keys.keys())
+    totals = dict((cache_keys[key], value) for key, value in cached.items())
+
+    missing = [name for name in names if name not in totals]
+    if missing:
+        keys = []
+        for name in missing:
+            keys.extend(_shard_keys(name))
+        for name in missing:
+            totals[name] = 0
+        for shard in ndb.get_multi(keys):
+            if shard:
+                totals[shard.key.id().rsplit('-', 1)[0]] += shard.count
+        # add rather than set, so a concurrent offset is not overwritten
+        memcache.add_multi(
+            dict((MEMCACHE_COUNTER.format(name), totals[name])
+                 for name in missing),
+            time=COUNTER_CACHE_SECONDS)
+    return totals
+
+
+def increment(deltas):
+    """Applies a dict of deltas to the named counters"""
+    increment_async(deltas).get_result()
+
+
+@ndb.tasklet
+def increment_async(deltas):
+    """Applies a dict of deltas to the named counters. Each counter gets
+    one random shard, all updated in a single transaction"""
+    deltas = dict((name, delta) for name, delta in deltas.items() if delta)
+    if not deltas:
+        return
+
+    @ndb.transactional_tasklet(xg=True)
+    def _txn():
+        keys = [_shard_key(name, random.randint(0, NUM_SHARDS - 1))
+                for name in deltas]
+        shards = yield ndb.get_multi_async(keys)
+        for index, name in enumerate(deltas):
+            shards[index] = shards[index] or CounterShard(key=keys[index])
+            shards[index].count += deltas[name]
+        yield ndb.put_multi_async(shards)
+    yield _txn()
+    # only offsets totals that are already cached; others are summed from
+    # the shards on their next read
+    context = ndb.get_context()
+    offsets = []
+    for name, delta in deltas.items():
+        cache_key = MEMCACHE_COUNTER.format(name)
+        if delta > 0:
+            offsets.append(context.memcache_incr(cache_key, delta))
+        else:
+            offsets.append(context.memcache_decr(cache_key, -delta))
+    yield offsets
+
+
+def reset(totals):
+    """Overwrites the named counters with the given totals"""
+    shards = []
+    for name, total in totals.items():
+        shards.extend(CounterShard(key=key, count=0)
+                      for key in _shard_keys(name))
+        shards[-NUM_SHARDS].count = total
+    ndb.put_multi(shards)
+    memcache.set_multi(
+        dict((MEMCACHE_COUNTER.format(name), total)
+             for name, total in totals.items()),
+        time=COUNTER_CACHE_SECONDS)
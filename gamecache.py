@@ -0,0 +1,292 @@
+"""gamecache.py - Memcache layer in front of in-progress Games.
+
+A game is only played by one user for a few minutes, so its state is kept in
+memcache while it is active. Moves are applied with compare-and-set and
+written back to the datastore by a delayed flush task, plus a write-through
+every WRITE_THROUGH_MOVES moves to bound what an eviction can lose. Finishing
+or cancelling a game writes to the datastore synchronously. If memcache is
+unavailable, moves are applied to the stored game in transactions."""
+
+import logging
+import pickle
+import random
+import time
+from datetime import datetime, timedelta
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import Game, GameArchive, GameConflictError, GameRedirect
+from utils import get_by_urlsafe
+
+import metrics
+
+MEMCACHE_GAME = 'GAME:{}'
+MEMCACHE_GAME_FLUSH = 'GAME_FLUSH:{}'
+MEMCACHE_GAME_VERSION = 'GAME_VERSION:{}'
+GAME_CACHE_SECONDS = 60 * 60
+FLUSH_DELAY_SECONDS = 30
+WRITE_THROUGH_MOVES = 5
+CAS_RETRIES = 5
+# a finishing request that has held its claim on a cached game this long is
+# assumed to have failed, and the game is reloaded from the datastore
+FINISH_CLAIM_SECONDS = 60
+# the backoff before retry n is a random time up to BACKOFF_SECONDS * 2 ** n
+BACKOFF_SECONDS = 0.01
+
+
+class ConcurrentMoveError(Exception):
+    """Raised when a move keeps losing compare-and-set races"""
+
+
+def get_game(urlsafe):
+    """Returns the Game that the urlsafe key points to, or None. Active
+    games are served from memcache and cached on a miss. Games are cached
+    under their current key, so an old key of a moved game reads the same
+    cached state as the new one"""
+    game = memcache.get(MEMCACHE_GAME.format(urlsafe))
+    if game is None:
+        game = _load_game(urlsafe)
+        if game:
+            resolved = game.key.urlsafe()
+            if resolved != urlsafe:
+                game = memcache.get(MEMCACHE_GAME.format(resolved)) or game
+            cached = {MEMCACHE_GAME_VERSION.format(resolved): game.version}
+            if not game.game_over:
+                cached[MEMCACHE_GAME.format(resolved)] = game
+            memcache.add_multi(cached, time=GAME_CACHE_SECONDS)
+    return game
+
+
+def with_cached(games):
+    """Returns a list of Games loaded from the datastore with each active
+    game replaced by its cached copy, read with one get_multi, since the
+    stored copy can be behind by the moves that are not flushed yet"""
+    keys = [MEMCACHE_GAME.format(game.key.urlsafe()) for game in games]
+    cached = memcache.get_multi(keys)
+    result = []
+    for key, game in zip(keys, games):
+        copy = cached.get(key)
+        # a cached copy that is over is a finish still being saved
+        result.append(copy if copy and not copy.game_over else game)
+    return result
+
+
+def get_version(urlsafe):
+    """Returns the cached version of a game, or None if it is not cached
+    under that key. Lets conditional reads be answered without loading the
+    game"""
+    return memcache.get(MEMCACHE_GAME_VERSION.format(urlsafe))
+
+
+def update_game(urlsafe, update):
+    """Applies update(game) to the Game that the urlsafe key points to and
+    returns a tuple of its result and the updated game, or (None, None) if
+    there is no such game. The cached state is replaced with
+    compare-and-set, and update is re-run on a fresh copy, after a random
+    backoff, if another request changed or finished the game first. update
+    must not have side effects beyond the game unless it ends the game,
+    since end_game saves synchronously. Before it saves, end_game claims the
+    cached game by compare-and-set with the finished copy, so a concurrent
+    move cannot be lost and other moves back off until the claim is
+    cleared. If update leaves the game's version unchanged, nothing is
+    written.
+    Raises:
+        ConcurrentMoveError: if every attempt lost a race"""
+    client = memcache.Client()
+    cache_key = MEMCACHE_GAME.format(urlsafe)
+    contended = False
+    for attempt in range(CAS_RETRIES):
+        if contended:
+            metrics.count('move_retries')
+            time.sleep(random.uniform(0, BACKOFF_SECONDS * 2 ** attempt))
+        contended = True
+        game = client.gets(cache_key)
+        if game is None:
+            game = _load_game(urlsafe)
+            if not game:
+                return None, None
+            if game.key.urlsafe() != urlsafe:
+                # an old key of a moved game; its state is cached under the
+                # current key
+                urlsafe = game.key.urlsafe()
+                cache_key = MEMCACHE_GAME.format(urlsafe)
+                contended = False
+                continue
+            if game.game_over:
+                # finished games are not cached, so nothing can race
+                return update(game), game
+            if (not client.add(cache_key, game, time=GAME_CACHE_SECONDS) and
+                    client.gets(cache_key) is None):
+                # memcache is unavailable, so the move goes straight to the
+                # datastore
+                return _update_stored_game(game.key, update)
+            contended = False
+            continue
+
+        if game.game_over:
+            # another request has claimed the game to finish it
+            if not game.ended or game.ended < datetime.now() - timedelta(
+                    seconds=FINISH_CLAIM_SECONDS):
+                # and never cleared its claim, so the game is reloaded
+                client.delete(cache_key)
+            continue
+
+        version = game.version
+        original = pickle.loads(pickle.dumps(game, pickle.HIGHEST_PROTOCOL))
+        claimed = []
+
+        def _claim(finished):
+            if not client.cas(cache_key, finished, time=GAME_CACHE_SECONDS):
+                raise GameConflictError('The game was changed concurrently.')
+            claimed.append(True)
+        game._claim_finish = _claim
+        try:
+            result = update(game)
+        except GameConflictError:
+            if claimed:
+                # the stored game was cancelled, finished or saved past the
+                # cached copy, so the retry reloads it
+                client.delete(cache_key)
+            continue
+        except Exception:
+            if claimed:
+                _release_claim(client, cache_key, original)
+            raise
+        if game.version == version:
+            return result, game
+        if game.game_over:
+            # end_game has saved the final state while holding the claim, so
+            # nothing else can have changed the cached copy
+            client.delete(cache_key)
+            _set_version(urlsafe, game)
+            return result, game
+        if client.cas(cache_key, game, time=GAME_CACHE_SECONDS):
+            _set_version(urlsafe, game)
+            _write_behind(urlsafe, game)
+            return result, game
+    metrics.count('move_conflicts')
+    logging.warning('Gave up on a move to game %s after %d attempts',
+                    urlsafe, CAS_RETRIES)
+    raise ConcurrentMoveError('Too many concurrent moves for this game.')
+
+
+def _release_claim(client, cache_key, original):
+    """Puts back the cached copy a failed finish claimed, unless the game
+    was saved as finished before the failure"""
+    stored = original.key.get(use_cache=False, use_memcache=False)
+    if not stored or stored.game_over:
+        client.delete(cache_key)
+    elif client.gets(cache_key) is not None:
+        client.cas(cache_key, original, time=GAME_CACHE_SECONDS)
+
+
+def _update_stored_game(key, update):
+    """Applies update(game) to the stored Game without the cache. A move
+    is saved in a transaction that checks nobody saved the game since it
+    was read, and retried otherwise; a move that ends the game is saved by
+    end_game's own transaction"""
+    for _ in range(CAS_RETRIES):
+        game = key.get(use_cache=False, use_memcache=False)
+        version = game.version
+        try:
+            result = update(game)
+        except GameConflictError:
+            continue
+        if (game.version == version or game.game_over or
+                _save_if_version(game, version)):
+            return result, game
+    raise ConcurrentMoveError('Too many concurrent moves for this game.')
+
+
+@ndb.transactional
+def _save_if_version(game, version):
+    """Puts a game if the stored copy is still at the given version"""
+    stored = game.key.get(use_cache=False, use_memcache=False)
+    if stored and not stored.game_over and stored.version == version:
+        game.put()
+        return True
+    return False
+
+
+def _set_version(urlsafe, game):
+    """Advances the cached version of a game with compare-and-set, never
+    moving it backwards, so a request that saved an older state cannot make
+    a stale ETag current again. Drops the version if it keeps losing
+    races, so reads fall back to loading the game"""
+    client = memcache.Client()
+    key = MEMCACHE_GAME_VERSION.format(urlsafe)
+    for _ in range(CAS_RETRIES):
+        version = client.gets(key)
+        if version is None:
+            if client.add(key, game.version, time=GAME_CACHE_SECONDS):
+                return
+        elif version >= game.version or client.cas(
+                key, game.version, time=GAME_CACHE_SECONDS):
+            return
+    client.delete(key)
+
+
+def _load_game(urlsafe):
+    """Loads a Game from the datastore, following the redirect left behind
+    if the game has been moved under its User and restoring it from its
+    GameArchive if it has been archived. Keys that resolve to nothing are
+    remembered for a short time by get_by_urlsafe, so polling a cancelled
+    game or a bad key does not reach the datastore every time"""
+    # ndb's caches could return the copy this request loaded before
+    # another request changed the game
+    return get_by_urlsafe(urlsafe, Game, use_cache=False, use_memcache=False,
+                          cache_missing=True, resolve=_resolve_moved)
+
+
+def _resolve_moved(key):
+    """Returns the Game a missing Game key was moved or archived to, or
+    None"""
+    redirect, archive = ndb.get_multi([ndb.Key(GameRedirect, key.urlsafe()),
+                                       GameArchive.key_for(key)])
+    game = None
+    if redirect:
+        game = redirect.target.get(use_cache=False, use_memcache=False)
+        if game is None:
+            archive = GameArchive.key_for(redirect.target).get()
+    if game is None and archive:
+        game = archive.to_game()
+    return game
+
+
+def _write_behind(urlsafe, game):
+    """Schedules a delayed flush of a cached game, at most one per
+    FLUSH_DELAY_SECONDS, and writes through every WRITE_THROUGH_MOVES"""
+    if len(game.guesses) % WRITE_THROUGH_MOVES == 0:
+        _save_if_current(game)
+    elif memcache.add(MEMCACHE_GAME_FLUSH.format(urlsafe), True,
+                      time=FLUSH_DELAY_SECONDS):
+        taskqueue.add(url='/tasks/flush_game', params={'game': urlsafe},
+                      countdown=FLUSH_DELAY_SECONDS)
+
+
+def flush_game(urlsafe):
+    """Writes the cached state of an active game to the datastore"""
+    game = memcache.get(MEMCACHE_GAME.format(urlsafe))
+    if game is None:
+        logging.info('Game %s left the cache before it was flushed', urlsafe)
+        return
+    if not game.game_over:
+        _save_if_current(game)
+
+
+@ndb.transactional
+def _save_if_current(game):
+    """Puts a cached game unless the stored copy has been cancelled,
+    finished or has seen more moves in the meantime"""
+    stored = game.key.get()
+    if (stored and not stored.game_over and
+            len(stored.guesses) <= len(game.guesses)):
+        game.put()
+
+
+def forget_game(urlsafe):
+    """Drops a game from the cache, for example once it is cancelled"""
+    memcache.delete_multi([MEMCACHE_GAME.format(urlsafe),
+                           MEMCACHE_GAME_VERSION.format(urlsafe)])
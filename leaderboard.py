@@ -0,0 +1,207 @@
+"""leaderboard.py - Precomputed top-N leaderboards for high scores and user
+rankings. Each board is a compact sorted list of entries kept in memcache
+and backed by a datastore snapshot. Boards are updated incrementally when a
+game ends and rebuilt from scratch by a cron job to repair any drift.
+
+User ranks beyond the board are answered from per-bucket counts of users'
+wins ratios instead of scanning every user ranked above."""
+
+import bisect
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+HIGH_SCORES = 'high_scores'
+USER_RANKINGS = 'user_rankings'
+
+TOP_N = 100
+RANK_BUCKETS = 100
+
+MEMCACHE_LEADERBOARD = 'LEADERBOARD:{}'
+MEMCACHE_LEADERBOARD_VERSION = 'LEADERBOARD_VERSION'
+LEADERBOARD_CACHE_SECONDS = 600
+
+# High score entries are [attempts_remaining, number_of_letters, user_name,
+# won, date] and user ranking entries are [wins, avg_attempts_remaining,
+# user_name]. Both sort best first with sorted(reverse=True).
+NAME_FIELD = 2
+
+
+class LeaderboardSnapshot(ndb.Model):
+    """Datastore copy of a top-N leaderboard"""
+    entries = ndb.JsonProperty(compressed=True)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+
+class RankBucket(ndb.Model):
+    """Number of users whose wins ratio falls into one bucket"""
+    count = ndb.IntegerProperty(default=0, indexed=False)
+
+
+class RankRecount(ndb.Model):
+    """Progress of one recount of the rank buckets. The cursor and the
+    counts of the users seen so far are checkpointed after each batch"""
+    cursor = ndb.StringProperty(indexed=False)
+    # maps str(bucket) to the number of users counted in it
+    counts = ndb.JsonProperty(indexed=False)
+    done = ndb.BooleanProperty(default=False, indexed=False)
+    started = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+
+def score_entry(score):
+    """Returns the leaderboard entry for a Score"""
+    return [score.attempts_remaining, score.number_of_letters,
+            score.user_name, score.won, str(score.date)]
+
+
+def user_entry(user):
+    """Returns the leaderboard entry for a User"""
+    return [user.wins, user.avg_attempts_remaining, user.name]
+
+
+def get_board(board):
+    """Returns the sorted entries of a leaderboard, best first, or None if
+    the board has never been built"""
+    return get_board_async(board).get_result()
+
+
+@ndb.tasklet
+def get_board_async(board):
+    """Tasklet version of get_board"""
+    context = ndb.get_context()
+    cache_key = MEMCACHE_LEADERBOARD.format(board)
+    entries = yield context.memcache_get(cache_key)
+    if entries is None:
+        snapshot = yield LeaderboardSnapshot.get_by_id_async(board)
+        if not snapshot:
+            raise ndb.Return(None)
+        entries = snapshot.entries
+        yield context.memcache_set(cache_key, entries,
+                                   time=LEADERBOARD_CACHE_SECONDS)
+    raise ndb.Return(entries)
+
+
+def get_version():
+    """Returns the global leaderboard version, which changes whenever
+    either board changes. If it has been evicted it restarts from the
+    clock, so it never repeats a version handed out before"""
+    version = memcache.get(MEMCACHE_LEADERBOARD_VERSION)
+    if version is None:
+        memcache.add(MEMCACHE_LEADERBOARD_VERSION, int(time.time() * 1000))
+        version = memcache.get(MEMCACHE_LEADERBOARD_VERSION)
+    return version
+
+
+def _qualifies(entries, entry):
+    """Returns True if entry belongs on a board holding entries"""
+    return len(entries) < TOP_N or entry > entries[-1]
+
+
+@ndb.tasklet
+def _update_board_async(board, entry, replace_user=False):
+    """Inserts entry into a board if it makes the top N. If replace_user is
+    True, any existing entry for the same user is removed first."""
+    cached = (yield get_board_async(board)) or []
+    on_board = replace_user and any(e[NAME_FIELD] == entry[NAME_FIELD]
+                                    for e in cached)
+    # most finished games do not make the board, so skip the transaction
+    if not on_board and not _qualifies(cached, entry):
+        return
+
+    @ndb.transactional_tasklet
+    def _txn():
+        snapshot = ((yield LeaderboardSnapshot.get_by_id_async(board)) or
+                    LeaderboardSnapshot(id=board, entries=[]))
+        entries = snapshot.entries
+        if replace_user:
+            entries = [e for e in entries
+                       if e[NAME_FIELD] != entry[NAME_FIELD]]
+        entries = sorted(entries + [entry], reverse=True)[:TOP_N]
+        snapshot.entries = entries
+        yield snapshot.put_async()
+        raise ndb.Return(entries)
+    entries = yield _txn()
+    context = ndb.get_context()
+    yield (context.memcache_set(MEMCACHE_LEADERBOARD.format(board), entries,
+                                time=LEADERBOARD_CACHE_SECONDS),
+           context.memcache_incr(MEMCACHE_LEADERBOARD_VERSION))
+
+
+def bucket_for(wins):
+    """Returns the rank bucket index for a wins ratio. Worked out from the
+    same bounds the rank query filters on, since int(wins * RANK_BUCKETS)
+    rounds some ratios equal to a bound into the bucket below it"""
+    return bisect.bisect_right(_BUCKET_BOUNDS, wins)
+
+
+@ndb.transactional_tasklet
+def _add_to_bucket_async(bucket, delta):
+    rank_bucket = ((yield RankBucket.get_by_id_async(str(bucket))) or
+                   RankBucket(id=str(bucket)))
+    rank_bucket.count += delta
+    yield rank_bucket.put_async()
+
+
+@ndb.tasklet
+def record_score_async(score):
+    """Adds a newly finished game's Score to the high score board"""
+    yield _update_board_async(HIGH_SCORES, score_entry(score))
+
+
+@ndb.tasklet
+def record_user_async(user, previous_wins):
+    """Updates a User's position on the rankings board and moves them
+    between rank buckets after their wins ratio changed from previous_wins"""
+    updates = [_update_board_async(USER_RANKINGS, user_entry(user),
+                                   replace_user=True)]
+    new_bucket = bucket_for(user.wins)
+    if previous_wins is None:
+        updates.append(_add_to_bucket_async(new_bucket, 1))
+    elif bucket_for(previous_wins) != new_bucket:
+        updates.append(_add_to_bucket_async(bucket_for(previous_wins), -1))
+        updates.append(_add_to_bucket_async(new_bucket, 1))
+    yield updates
+
+
+def users_above_bucket(bucket):
+    """Returns the number of users in rank buckets above bucket"""
+    keys = [ndb.Key(RankBucket, str(b))
+            for b in range(bucket + 1, RANK_BUCKETS)]
+    return sum(b.count for b in ndb.get_multi(keys) if b)
+
+
+def bucket_upper_bound(bucket):
+    """Returns the exclusive upper wins bound of a bucket, or None for the
+    top bucket"""
+    if bucket == RANK_BUCKETS - 1:
+        return None
+    return (bucket + 1) / float(RANK_BUCKETS)
+
+
+# the upper bound of every bucket but the top one, in order
+_BUCKET_BOUNDS = [bucket_upper_bound(b) for b in range(RANK_BUCKETS - 1)]
+
+
+def rebuild(score_entries, user_entries):
+    """Replaces both boards with freshly computed entries"""
+    snapshots = [
+        LeaderboardSnapshot(id=HIGH_SCORES,
+                            entries=sorted(score_entries,
+                                           reverse=True)[:TOP_N]),
+        LeaderboardSnapshot(id=USER_RANKINGS,
+                            entries=sorted(user_entries,
+                                           reverse=True)[:TOP_N])]
+    ndb.put_multi(snapshots)
+    memcache.set_multi(
+        dict((MEMCACHE_LEADERBOARD.format(s.key.id()), s.entries)
+             for s in snapshots),
+        time=LEADERBOARD_CACHE_SECONDS)
+    memcache.incr(MEMCACHE_LEADERBOARD_VERSION)
+
+
+def reset_buckets(bucket_counts):
+    """Replaces all rank bucket counts with a dict of freshly counted
+    users per bucket"""
+    ndb.put_multi([RankBucket(id=str(b), count=bucket_counts.get(b, 0))
+                   for b in range(RANK_BUCKETS)])
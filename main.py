@@ -2,41 +2,564 @@
 
 """main.py - This file contains handlers that are called by taskqueue and/or
 cronjobs."""
+import json
+import logging
+import time
 import webapp2
+from datetime import date, datetime, timedelta
 from google.appengine.api import mail, app_identity
-from api import HangmanApi
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
 
-from models import User, Game
+from models import User, Game, GameArchive, Score, GameRedirect,\
+    ReminderRun, get_user_names, DUAL_READ_ROOT_ENTITIES
+
+import counters
+import gamecache
+import leaderboard
+import metrics
+import stats
+import words
+
+BACKFILL_BATCH_SIZE = 50
+MIGRATION_BATCH_SIZE = 20
+REFERENCE_BATCH_SIZE = 100
+REMINDER_BATCH_SIZE = 100
+RECOUNT_BATCH_SIZE = 500
+STATS_BATCH_SIZE = 100
+PARENT_MIGRATION_BATCH_SIZE = 100
+ARCHIVE_BATCH_SIZE = 100
+# finished games older than this are moved to GameArchive
+ARCHIVE_AFTER_DAYS = 30
+CUTOFF_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+def _legacy_scores(user_key):
+    """Returns a user's Scores that are not children of the user. Scores
+    have been created under their User since the parent migration, so the
+    eventually consistent query sees every legacy Score"""
+    if not DUAL_READ_ROOT_ENTITIES:
+        return []
+    return [score for score in Score.query(Score.user == user_key)
+            if score.key.parent() != user_key]
+
+
+class BatchedRunTask(webapp2.RequestHandler):
+    """Base for jobs that page through a query one batch per task. The
+    cursor is checkpointed on a run entity, in a transaction that also
+    enqueues the next task, so a retried task cannot process a batch twice
+    and a killed run resumes where it stopped. Subclasses set run_model,
+    url and batch_size and implement query, process and checkpoint, and
+    may implement finish"""
+    run_model = None
+    url = None
+    batch_size = 100
+    keys_only = False
+
+    @classmethod
+    def start(cls, run_id, **fields):
+        """Creates the run entity with fields and enqueues its first task"""
+        cls.run_model.get_or_insert(run_id, **fields)
+        try:
+            # the task name makes a second start of the same run a no-op
+            taskqueue.add(url=cls.url, params={'run': run_id},
+                          name='{}-{}-0'.format(
+                              cls.url.rsplit('/', 1)[-1].replace('_', '-'),
+                              run_id))
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            pass
+
+    def post(self):
+        """Process the next batch, from the cursor checkpointed on the run.
+        The last batch enqueues a final task that calls finish"""
+        run_id = self.request.get('run')
+        run = self.run_model.get_by_id(run_id)
+        if run and run.done and self.request.get('finish'):
+            self.finish(run)
+            return
+        if not run or run.done:
+            return
+        cursor = run.cursor
+        options = {'keys_only': True} if self.keys_only else {}
+        entities, next_cursor, more = self.query(run).fetch_page(
+            self.batch_size,
+            start_cursor=Cursor(urlsafe=cursor) if cursor else None,
+            **options)
+        result = self.process(run, entities)
+        more = bool(more and next_cursor)
+
+        @ndb.transactional
+        def _checkpoint():
+            run = self.run_model.get_by_id(run_id)
+            if run.cursor != cursor or run.done:
+                # a retry of this task already checkpointed this batch
+                return
+            self.checkpoint(run, result)
+            if more:
+                run.cursor = next_cursor.urlsafe()
+                taskqueue.add(url=self.url, params={'run': run_id},
+                              transactional=True)
+            else:
+                run.done = True
+                taskqueue.add(url=self.url,
+                              params={'run': run_id, 'finish': 1},
+                              transactional=True)
+            run.put()
+        _checkpoint()
+
+    def query(self, run):
+        """Returns the query to page through"""
+        raise NotImplementedError
+
+    def process(self, run, entities):
+        """Does the work for one batch of entities and returns a result for
+        checkpoint. Runs outside the checkpoint transaction"""
+        raise NotImplementedError
+
+    def checkpoint(self, run, result):
+        """Adds a batch's result to the run, inside the checkpoint
+        transaction"""
+        raise NotImplementedError
+
+    def finish(self, run):
+        """Runs once after the last batch has been checkpointed"""
+
+
+class Warmup(webapp2.RequestHandler):
+    def get(self):
+        """Prepare a new instance before it serves user requests: build the
+        endpoints service, load the word store and its hint indexes, and
+        read the leaderboards and counters so they are cached in memcache.
+        Called by App Engine when it starts an instance"""
+        start = time.time()
+        import api  # noqa: builds the endpoints service
+        words.get_store().build_indexes()
+        ndb.Future.wait_all([leaderboard.get_board_async(board) for board in
+                             (leaderboard.HIGH_SCORES,
+                              leaderboard.USER_RANKINGS)])
+        counters.get_counts([counters.ACTIVE_GAMES,
+                             counters.ACTIVE_ATTEMPTS_REMAINING])
+        leaderboard.get_version()
+        logging.info('Warmup took %.0f ms', (time.time() - start) * 1000)
 
 
 class SendReminderEmail(webapp2.RequestHandler):
     def get(self):
-        """Send a reminder email to each User with an email who has active games.
-        Called every hour using a cron job"""
+        """Start today's run of reminder emails to each User with an email
+        who has active games. Called every 24 hours using a cron job"""
+        ScanReminderUsers.start(date.today().isoformat())
+
+
+class ScanReminderUsers(BatchedRunTask):
+    run_model = ReminderRun
+    url = '/tasks/reminder_scan'
+    batch_size = REMINDER_BATCH_SIZE
+
+    def query(self, run):
+        """Returns a query for the distinct users with active games"""
+        # a distinct projection on user yields each user with active games
+        # once, without loading the games or querying per user
+        return Game.query(Game.game_over == False,  # noqa
+                          projection=[Game.user], distinct=True)
+
+    def process(self, run, games):
+        """Returns the urlsafe keys of a batch of users"""
+        return [game.user.urlsafe() for game in games]
+
+    def checkpoint(self, run, user_keys):
+        """Fans the batch of users out to a send task"""
+        if user_keys:
+            taskqueue.add(url='/tasks/reminder_send',
+                          params={'run': run.key.id(), 'user': user_keys},
+                          transactional=True)
+        run.batches += 1
+
+
+class SendReminderBatch(webapp2.RequestHandler):
+    def post(self):
+        """Send reminder emails to one batch of users. Each user is marked
+        as reminded only after their email is sent, so a retried batch
+        skips users already mailed and retries the rest"""
+        run_date = datetime.strptime(self.request.get('run'),
+                                     '%Y-%m-%d').date()
+        keys = [ndb.Key(urlsafe=key) for key in self.request.get_all('user')]
         app_id = app_identity.get_application_id()
-        users = User.query(User.email != None)  # noqa
+        for user in ndb.get_multi(keys):
+            if not user or not user.email or user.last_reminder == run_date:
+                continue
+            subject = 'This is a reminder!'
+            body = 'Hello {}, try out Hangman!'.format(user.name)
+            # This will send test emails, the arguments to send_mail are:
+            # from, to, subject, body
+            mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
+                           user.email,
+                           subject,
+                           body)
+            self._mark_reminded(user.key, run_date)
+
+    @staticmethod
+    @ndb.transactional
+    def _mark_reminded(user_key, run_date):
+        # a transaction, so a game finishing meanwhile is not overwritten
+        user = user_key.get()
+        user.last_reminder = run_date
+        user.put()
+
+
+class ReconcileAverageMovesRemaining(webapp2.RequestHandler):
+    def get(self):
+        """Check the active game counters against a full scan of active
+        Games. Called every 6 hours using a cron job"""
+        # imported here so instances serving only tasks and crons do not
+        # build the endpoints service
+        from api import HangmanApi
+        HangmanApi._reconcile_average_attempts()
+
+    def post(self):
+        """Tasks enqueued before the counters existed run the same check."""
+        from api import HangmanApi
+        HangmanApi._reconcile_average_attempts()
+        self.response.set_status(204)
+
+
+class FlushGame(webapp2.RequestHandler):
+    def post(self):
+        """Write a cached in-progress game back to the datastore"""
+        gamecache.flush_game(self.request.get('game'))
+        self.response.set_status(204)
+
+
+class RebuildLeaderboards(webapp2.RequestHandler):
+    def get(self):
+        """Rebuild the high score and user ranking boards from scratch and
+        start a recount of the rank buckets, repairing any drift from
+        incremental updates. Called every hour using a cron job"""
+        scores = Score.query().order(-Score.attempts_remaining,
+                                     -Score.number_of_letters)\
+            .fetch(leaderboard.TOP_N)
+        names = get_user_names(scores)
+        for score in scores:
+            score.user_name = names.get(score.user)
+        users = User.query().order(-User.wins,
+                                   -User.avg_attempts_remaining)\
+            .fetch(leaderboard.TOP_N)
+        leaderboard.rebuild([leaderboard.score_entry(s) for s in scores],
+                            [leaderboard.user_entry(u) for u in users
+                             if u.wins is not None])
+
+        RecountRankBuckets.start(datetime.now().strftime('%Y-%m-%d-%H'))
+
+
+class RecountRankBuckets(BatchedRunTask):
+    run_model = leaderboard.RankRecount
+    url = '/tasks/recount_rank_buckets'
+    batch_size = RECOUNT_BATCH_SIZE
+
+    def query(self, run):
+        """Returns a query for every user's wins ratio"""
+        return User.query(projection=[User.wins])
+
+    def process(self, run, users):
+        """Counts a batch of users into rank buckets"""
+        batch_counts = {}
         for user in users:
-            active_games = Game.query(Game.user == user.key,
-                                      Game.game_over == False)  # noqa
-            if active_games.count():
-                subject = 'This is a reminder!'
-                body = 'Hello {}, try out Hangman!'.format(user.name)
-                # This will send test emails, the arguments to send_mail are:
-                # from, to, subject, body
-                mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
-                               user.email,
-                               subject,
-                               body)
-
-
-class UpdateAverageMovesRemaining(webapp2.RequestHandler):
-    def post(self):
-        """Update game listing announcement in memcache."""
-        HangmanApi._cache_average_attempts()
+            if user.wins is not None:
+                bucket = str(leaderboard.bucket_for(user.wins))
+                batch_counts[bucket] = batch_counts.get(bucket, 0) + 1
+        return batch_counts
+
+    def checkpoint(self, run, batch_counts):
+        """Adds a batch's bucket counts to the run's"""
+        counts = dict(run.counts or {})
+        for bucket, count in batch_counts.items():
+            counts[bucket] = counts.get(bucket, 0) + count
+        run.counts = counts
+
+    def finish(self, run):
+        """Replaces the bucket counts with the recounted ones"""
+        leaderboard.reset_buckets(dict(
+            (int(bucket), count)
+            for bucket, count in (run.counts or {}).items()))
+
+
+class RebuildStats(BatchedRunTask):
+    run_model = stats.StatsRebuild
+    url = '/tasks/rebuild_stats'
+    batch_size = STATS_BATCH_SIZE
+    keys_only = True
+
+    def get(self):
+        """Start a rebuild of the recent per-user and global stats rollups
+        from Scores, repairing any drift from incremental updates. Called
+        every 24 hours using a cron job"""
+        today = date.today()
+        self.start(today.isoformat(), today=today)
+
+    def query(self, run):
+        """Returns a query for every user"""
+        return User.query()
+
+    def process(self, run, user_keys):
+        """Rebuilds the rollups of a batch of users and returns their
+        Scores"""
+        first = stats.rebuild_start(run.today)
+        scores = []
+        for user_key in user_keys:
+            legacy_scores = [score for score in _legacy_scores(user_key)
+                             if score.date >= first]
+            scores.extend(self._rebuild_user(user_key, legacy_scores, first))
+        return scores
+
+    def checkpoint(self, run, scores):
+        """Adds the batch's Scores to the run's global totals"""
+        run.totals = stats.add_closed_totals(dict(run.totals or {}),
+                                             scores, run.today)
+
+    def finish(self, run):
+        """Rewrites the global rollups from the run's totals"""
+        stats.rebuild_global(run.totals or {}, run.today)
+
+    @staticmethod
+    @ndb.transactional
+    def _rebuild_user(user_key, legacy_scores, first):
+        """Rewrites one user's rollups from their Scores dated from first
+        on, returning the Scores. Scores that are children of the user are
+        read with a strongly consistent ancestor query inside the
+        transaction, so a game that finishes meanwhile is either counted or
+        retries the transaction"""
+        scores = legacy_scores + Score.query(Score.date >= first,
+                                             ancestor=user_key).fetch()
+        ndb.put_multi(stats.user_rollups(user_key, scores))
+        return scores
+
+
+class BackfillUserStats(webapp2.RequestHandler):
+    def get(self):
+        """Kick off the one-off backfill from the browser (admin only)."""
+        taskqueue.add(url='/tasks/backfill_user_stats')
+        self.response.write('User stats backfill started.')
+
+    def post(self):
+        """Seed the running games_played/games_won/total_attempts_remaining
+        aggregates on each User from their existing Scores. Processes one
+        batch of users per task and enqueues itself with the next cursor.
+        Each user is recomputed and saved in a transaction, so a game that
+        finishes meanwhile is either counted or retries the transaction."""
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        user_keys, next_cursor, more = User.query().fetch_page(
+            BACKFILL_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+        for user_key in user_keys:
+            self._recompute(user_key, _legacy_scores(user_key))
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/backfill_user_stats',
+                          params={'cursor': next_cursor.urlsafe()})
+        self.response.set_status(204)
+
+    @staticmethod
+    @ndb.transactional
+    def _recompute(user_key, legacy_scores):
+        """Rebuilds one user's aggregates from their Scores. Scores that are
+        children of the user are read with a strongly consistent ancestor
+        query inside the transaction"""
+        user = user_key.get()
+        if not user:
+            return
+        user.games_played = 0
+        user.games_won = 0
+        user.total_attempts_remaining = 0.0
+        for score in legacy_scores + Score.query(ancestor=user_key).fetch():
+            user.record_score(score.won, score.attempts_remaining)
+        user.put()
+
+
+class MigrateUserKeys(webapp2.RequestHandler):
+    def get(self):
+        """Kick off the user key migration from the browser (admin only)."""
+        taskqueue.add(url='/tasks/migrate_user_keys')
+        self.response.write('User key migration started.')
+
+    def post(self):
+        """Re-key Users created with numeric ids so they are keyed by name,
+        and point their Games and Scores at the new key. Processes one batch
+        of users per task and enqueues itself with the next cursor."""
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        users, next_cursor, more = User.query().fetch_page(
+            MIGRATION_BATCH_SIZE, start_cursor=cursor)
+        for user in users:
+            if user.key.id() != user.name:
+                self._rekey(user)
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/migrate_user_keys',
+                          params={'cursor': next_cursor.urlsafe()})
+        self.response.set_status(204)
+
+    @staticmethod
+    def _rekey(user):
+        """Moves user's references to a name keyed entity, then adds its
+        aggregates to that entity and deletes it in one transaction. Users
+        that the old create_user let share a name are merged this way, and
+        a retried task cannot add the same aggregates twice"""
+        new_key = User.get_or_insert(user.name, name=user.name,
+                                     email=user.email).key
+        for model in (Game, Score):
+            query = model.query(model.user == user.key)
+            cursor, more = None, True
+            while more:
+                entities, cursor, more = query.fetch_page(
+                    REFERENCE_BATCH_SIZE, start_cursor=cursor)
+                for index, entity in enumerate(entities):
+                    if model is Game and not entity.game_over:
+                        # the cache may hold moves that have not been
+                        # flushed yet, and must not flush the old user key
+                        urlsafe = entity.key.urlsafe()
+                        cached = gamecache.get_game(urlsafe)
+                        if cached and not cached.game_over:
+                            entity = entities[index] = cached
+                        gamecache.forget_game(urlsafe)
+                        # in-flight copies of the game fail to finish
+                        entity.version += 1
+                    entity.user = new_key
+                    entity.user_name = user.name
+                ndb.put_multi(entities)
+
+        @ndb.transactional(xg=True)
+        def _merge():
+            old, new = ndb.get_multi([user.key, new_key])
+            if not old:
+                return
+            logging.info('Merging user %s into %s', old.key.id(),
+                         new_key.id())
+            new.games_played += old.games_played or 0
+            new.games_won += old.games_won or 0
+            new.total_attempts_remaining += old.total_attempts_remaining or 0
+            new.update_ratios()
+            new.email = new.email or old.email
+            new.last_reminder = max(new.last_reminder, old.last_reminder)
+            new.put()
+            old.key.delete()
+        _merge()
+
+
+class MigrateGameParents(webapp2.RequestHandler):
+    def get(self):
+        """Kick off the game parent migration from the browser (admin only).
+        Run it after /tasks/migrate_user_keys has finished."""
+        for kind in ('Game', 'Score'):
+            taskqueue.add(url='/tasks/migrate_game_parents',
+                          params={'kind': kind})
+        self.response.write('Game parent migration started.')
+
+    def post(self):
+        """Move one batch of Games or Scores that are not children of their
+        User under it, and enqueue the next batch with the cursor. Moved
+        Games leave a GameRedirect so their old urlsafe keys still work."""
+        model = Game if self.request.get('kind') == 'Game' else Score
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        entities, next_cursor, more = model.query().fetch_page(
+            PARENT_MIGRATION_BATCH_SIZE, start_cursor=cursor)
+
+        moved, old_keys = [], []
+        for entity in entities:
+            if entity.key.parent() == entity.user:
+                continue
+            if model is Game and not entity.game_over:
+                # the cache may hold moves that have not been flushed yet
+                cached = gamecache.get_game(entity.key.urlsafe())
+                if cached and not cached.game_over:
+                    entity = cached
+                gamecache.forget_game(entity.key.urlsafe())
+            new_entity = model(parent=entity.user, id=entity.key.id(),
+                               **entity.to_dict())
+            moved.append(new_entity)
+            old_keys.append(entity.key)
+            if model is Game:
+                moved.append(GameRedirect(id=entity.key.urlsafe(),
+                                          target=new_entity.key))
+        ndb.put_multi(moved)
+        ndb.delete_multi(old_keys)
+
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/migrate_game_parents',
+                          params={'kind': self.request.get('kind'),
+                                  'cursor': next_cursor.urlsafe()})
         self.response.set_status(204)
 
 
+class CompactGames(webapp2.RequestHandler):
+    def get(self):
+        """Start archiving finished games. Called every 24 hours using a
+        cron job. A days parameter overrides ARCHIVE_AFTER_DAYS. Games that
+        finished before ended was indexed are only found by a one-off run
+        with legacy=1, which scans every finished Game"""
+        days = int(self.request.get('days') or ARCHIVE_AFTER_DAYS)
+        cutoff = datetime.now() - timedelta(days=days)
+        taskqueue.add(url='/tasks/compact_games',
+                      params={'cutoff': cutoff.strftime(CUTOFF_FORMAT),
+                              'legacy': self.request.get('legacy')})
+
+    def post(self):
+        """Move one batch of finished Games that ended before the cutoff to
+        GameArchive, delete the originals and enqueue the next batch with
+        the cursor."""
+        cutoff = datetime.strptime(self.request.get('cutoff'),
+                                   CUTOFF_FORMAT)
+        legacy = self.request.get('legacy')
+        if legacy:
+            query = Game.query(Game.game_over == True)  # noqa
+        else:
+            query = Game.query(Game.game_over == True,  # noqa
+                               Game.ended < cutoff)
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        games, next_cursor, more = query.fetch_page(ARCHIVE_BATCH_SIZE,
+                                                    start_cursor=cursor)
+        if legacy:
+            games = [game for game in games
+                     if game.ended is None or game.ended < cutoff]
+        # archive before deleting, so a retried task can finish the batch
+        ndb.put_multi([GameArchive.from_game(game) for game in games])
+        ndb.delete_multi([game.key for game in games])
+
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/compact_games',
+                          params={'cutoff': self.request.get('cutoff'),
+                                  'legacy': legacy,
+                                  'cursor': next_cursor.urlsafe()})
+        self.response.set_status(204)
+
+
+class MetricsReport(webapp2.RequestHandler):
+    def get(self):
+        """Report sampled latency percentiles and mean RPC counts per API
+        method and handler as JSON, over the last 'hours' hours (admin
+        only)."""
+        try:
+            hours = int(self.request.get('hours', metrics.REPORT_WINDOWS))
+        except ValueError:
+            hours = metrics.REPORT_WINDOWS
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(metrics.report(hours), indent=2,
+                                       sort_keys=True))
+
+
 app = webapp2.WSGIApplication([
+    ('/_ah/warmup', Warmup),
     ('/crons/send_reminder', SendReminderEmail),
-    ('/tasks/cache_average_attempts', UpdateAverageMovesRemaining),
+    ('/tasks/reminder_scan', ScanReminderUsers),
+    ('/tasks/reminder_send', SendReminderBatch),
+    ('/crons/rebuild_leaderboards', RebuildLeaderboards),
+    ('/tasks/recount_rank_buckets', RecountRankBuckets),
+    ('/crons/rebuild_stats', RebuildStats),
+    ('/tasks/rebuild_stats', RebuildStats),
+    ('/tasks/cache_average_attempts', ReconcileAverageMovesRemaining),
+    ('/crons/reconcile_average_attempts', ReconcileAverageMovesRemaining),
+    ('/tasks/flush_game', FlushGame),
+    ('/tasks/backfill_user_stats', BackfillUserStats),
+    ('/tasks/migrate_user_keys', MigrateUserKeys),
+    ('/tasks/migrate_game_parents', MigrateGameParents),
+    ('/crons/compact_games', CompactGames),
+    ('/tasks/compact_games', CompactGames),
+    ('/admin/metrics', MetricsReport),
 ], debug=True)
+app = metrics.instrument_wsgi(app)
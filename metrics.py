@@ -0,0 +1,239 @@
+"""metrics.py - Per-request latency and RPC instrumentation.
+
+The instrumented decorator (for endpoints methods) and instrument_wsgi
+(for the handlers in main.py) time a sampled fraction of requests and count
+the datastore, memcache and taskqueue RPCs they make using API proxy hooks,
+plus contention events reported with count(). Each sampled request is logged
+as one JSON line and added to per-method latency histograms and RPC totals in
+memcache, which report() turns into p50/p95/p99 figures. Requests that are
+not sampled only pay for one random number and one thread-local lookup per
+RPC. The histograms and totals are kept per hour, so report() covers the
+last few hours rather than everything since memcache last evicted them."""
+
+import contextlib
+import functools
+import json
+import logging
+import random
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+
+# fraction of requests that are measured
+SAMPLE_RATE = 0.1
+
+# upper bounds, in milliseconds, of the latency histogram buckets
+LATENCY_BUCKETS = (5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000,
+                   30000, 60000)
+
+COUNTERS = ('datastore_get', 'datastore_put', 'datastore_query',
+            'datastore_delete', 'memcache_hit', 'memcache_miss',
+            'memcache_other', 'taskqueue_add', 'move_retries',
+            'move_conflicts')
+
+WINDOW_SECONDS = 60 * 60
+# number of hourly windows that report() covers by default
+REPORT_WINDOWS = 24
+
+MEMCACHE_METHODS = 'METRICS:{}:methods'
+MEMCACHE_LATENCY = 'METRICS:{}:{}:latency:{}'
+MEMCACHE_TOTAL = 'METRICS:{}:{}:{}'
+METRICS_CACHE_SECONDS = (REPORT_WINDOWS + 1) * WINDOW_SECONDS
+
+_DATASTORE_CALLS = {
+    'Get': 'datastore_get',
+    'Put': 'datastore_put',
+    'RunQuery': 'datastore_query',
+    'Delete': 'datastore_delete',
+}
+
+_local = threading.local()
+# (window, method name) pairs this instance has registered
+_methods = set()
+
+
+def _pre_call_hook(service, call, request, response):
+    stats = getattr(_local, 'stats', None)
+    if stats is None:
+        return
+    if service == 'datastore_v3' and call in _DATASTORE_CALLS:
+        stats[_DATASTORE_CALLS[call]] += 1
+    elif service == 'taskqueue' and call in ('Add', 'BulkAdd'):
+        stats['taskqueue_add'] += 1
+    elif service == 'memcache' and call != 'Get':
+        stats['memcache_other'] += 1
+
+
+def _post_call_hook(service, call, request, response):
+    stats = getattr(_local, 'stats', None)
+    if stats is None or service != 'memcache' or call != 'Get':
+        return
+    hits = response.item_size()
+    stats['memcache_hit'] += hits
+    stats['memcache_miss'] += request.key_size() - hits
+
+
+apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+    'metrics', _pre_call_hook)
+apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+    'metrics', _post_call_hook)
+
+
+def count(counter, value=1):
+    """Adds value to one of COUNTERS for the current request, if it is
+    being measured. Used for events other than RPCs, such as retries"""
+    stats = getattr(_local, 'stats', None)
+    if stats is not None:
+        stats[counter] += value
+
+
+def _start():
+    """Starts measuring the current request if it is sampled. Returns the
+    start time, or None if the request is not sampled"""
+    if random.random() >= SAMPLE_RATE:
+        return None
+    _local.stats = dict.fromkeys(COUNTERS, 0)
+    return time.time()
+
+
+def _window():
+    return int(time.time() // WINDOW_SECONDS)
+
+
+def _finish(name, start):
+    """Logs and aggregates the measurements of the current request"""
+    elapsed_ms = (time.time() - start) * 1000
+    stats, _local.stats = _local.stats, None
+    logging.info('metrics %s', json.dumps(
+        dict(stats, method=name, latency_ms=round(elapsed_ms, 1))))
+
+    bucket = len(LATENCY_BUCKETS)
+    for index, bound in enumerate(LATENCY_BUCKETS):
+        if elapsed_ms <= bound:
+            bucket = index
+            break
+    window = _window()
+    offsets = {MEMCACHE_LATENCY.format(window, name, bucket): 1}
+    for counter, value in stats.items():
+        if value:
+            offsets[MEMCACHE_TOTAL.format(window, name, counter)] = value
+    memcache.offset_multi(offsets, initial_value=0)
+    # each window has its own registry, so one that memcache evicted is
+    # filled again by the next window instead of staying empty
+    if (window, name) not in _methods:
+        if _register(window, name):
+            _methods.add((window, name))
+
+
+def _register(window, name):
+    """Adds a method name to the set listed by report() for a window.
+    Returns whether it is registered"""
+    client = memcache.Client()
+    key = MEMCACHE_METHODS.format(window)
+    for _ in range(3):
+        methods = client.gets(key)
+        if methods is None:
+            if client.add(key, set([name]), time=METRICS_CACHE_SECONDS):
+                return True
+        elif name in methods or client.cas(key, methods | set([name]),
+                                           time=METRICS_CACHE_SECONDS):
+            return True
+    return False
+
+
+def instrumented(func):
+    """Decorator that measures a sampled fraction of calls to an endpoints
+    method. Apply it below @endpoints.method"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = _start()
+        if start is None:
+            return func(*args, **kwargs)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _finish(func.__name__, start)
+    return wrapper
+
+
+def instrument_wsgi(app):
+    """Wraps a WSGI application so a sampled fraction of its requests are
+    measured, using the request path as the method name"""
+    def middleware(environ, start_response):
+        start = _start()
+        if start is None:
+            return app(environ, start_response)
+        try:
+            return app(environ, start_response)
+        finally:
+            _finish(environ.get('PATH_INFO', ''), start)
+    return middleware
+
+
+@contextlib.contextmanager
+def collect():
+    """Counts the RPCs made inside the block into the yielded dict, without
+    logging or aggregating them. Used by benchmark.py"""
+    previous = getattr(_local, 'stats', None)
+    stats = _local.stats = dict.fromkeys(COUNTERS, 0)
+    try:
+        yield stats
+    finally:
+        _local.stats = previous
+
+
+def _percentile(counts, total, fraction):
+    """Returns the upper bound of the bucket holding the given fraction of
+    requests, or None if it is the open-ended last bucket"""
+    seen = 0
+    for index, count in enumerate(counts):
+        seen += count
+        if seen >= fraction * total:
+            if index < len(LATENCY_BUCKETS):
+                return LATENCY_BUCKETS[index]
+            return None
+    return None
+
+
+def report(windows=REPORT_WINDOWS):
+    """Returns a dict of the sampled request count, p50/p95/p99 latency
+    bucket bounds in milliseconds and mean RPC counts for each method, over
+    the given number of hourly windows up to and including the current
+    one"""
+    windows = max(1, min(windows, REPORT_WINDOWS))
+    current = _window()
+    recent = range(current - windows + 1, current + 1)
+    registries = memcache.get_multi(
+        [MEMCACHE_METHODS.format(window) for window in recent])
+    methods = sorted(set().union(*registries.values()))
+    keys = []
+    for window in recent:
+        for name in methods:
+            keys.extend(MEMCACHE_LATENCY.format(window, name, bucket)
+                        for bucket in range(len(LATENCY_BUCKETS) + 1))
+            keys.extend(MEMCACHE_TOTAL.format(window, name, counter)
+                        for counter in COUNTERS)
+    values = memcache.get_multi(keys)
+
+    def _sum(key, *args):
+        return sum(int(values.get(key.format(window, *args), 0))
+                   for window in recent)
+
+    result = {}
+    for name in methods:
+        counts = [_sum(MEMCACHE_LATENCY, name, bucket)
+                  for bucket in range(len(LATENCY_BUCKETS) + 1)]
+        total = sum(counts)
+        if not total:
+            continue
+        method = {'sampled_requests': total,
+                  'p50_ms': _percentile(counts, total, 0.50),
+                  'p95_ms': _percentile(counts, total, 0.95),
+                  'p99_ms': _percentile(counts, total, 0.99)}
+        for counter in COUNTERS:
+            value = _sum(MEMCACHE_TOTAL, name, counter)
+            method['mean_' + counter] = round(float(value) / total, 2)
+        result[name] = method
+    return result
@@ -3,28 +3,138 @@ entities used by the Game. Because these classes are also regular Python
 classes they can include methods (such as 'to_form' and 'new_game')."""
 
 from __future__ import division
-from datetime import date
+from datetime import date, datetime
 
 from protorpc import messages
 from google.appengine.ext import ndb
 
 import time
-import random
 import json
-
-ALLOWED_NUM_OF_LETTERS = [5, 6, 7]
-
-FIVE_LETTER_WORDS = ['music', 'night', 'house', 'earth', 'paper']
-SIX_LETTER_WORDS = ['family', 'mother', 'father', 'school', 'friend']
-SEVEN_LETTER_WORDS = ['sparkle', 'firefly', 'freckle', 'stellar', 'acrobat']
+import string
+
+import counters
+import leaderboard
+import stats
+import words
+
+
+# Users are keyed by name. Users created before that are found by a query
+# on name until /tasks/migrate_user_keys has re-keyed them; then set this to
+# False so user lookups and creation never query.
+DUAL_READ_NUMERIC_USER_KEYS = True
+
+# Games and Scores are created as children of their User. Entities created
+# before that are found by their user property until
+# /tasks/migrate_game_parents has finished; then set this to False so
+# per-user reads are strongly consistent ancestor queries.
+DUAL_READ_ROOT_ENTITIES = True
+
+# number of idempotency receipts kept on each Game
+MAX_RECEIPTS = 10
+
+# bit for each letter in a Game's guessed_letters mask
+LETTER_BITS = dict((letter, 1 << index)
+                   for index, letter in enumerate(string.ascii_lowercase))
+
+
+class GameConflictError(Exception):
+    """Raised by end_game when the stored game has been cancelled, has
+    already finished or has moved past the copy being ended"""
+
+
+def game_etag(version):
+    """Returns the ETag of the given version of a Game"""
+    return '"{}"'.format(version)
+
+
+def get_user_names(entities):
+    """Returns a dict mapping user keys to user names for a result set of
+    Games or Scores. Names are taken from the denormalized user_name
+    property, then from name based keys, and any remaining users are
+    resolved with a single get_multi (served from ndb's request-scoped
+    in-context cache when already loaded)."""
+    names = {}
+    missing = set()
+    for entity in entities:
+        if entity.user in names:
+            continue
+        if entity.user_name:
+            names[entity.user] = entity.user_name
+        elif isinstance(entity.user.id(), basestring):
+            names[entity.user] = entity.user.id()
+        else:
+            missing.add(entity.user)
+    if missing:
+        for user in ndb.get_multi(list(missing), use_cache=True):
+            if user:
+                names[user.key] = user.name
+    return names
 
 
 class User(ndb.Model):
-    """User profile"""
+    """User profile. Keyed by name, so lookups are strongly consistent gets"""
     name = ndb.StringProperty(required=True)
     email = ndb.StringProperty()
     wins = ndb.FloatProperty()
     avg_attempts_remaining = ndb.FloatProperty()
+    # running aggregates, so finishing a game does not rescan every Score
+    games_played = ndb.IntegerProperty(default=0)
+    games_won = ndb.IntegerProperty(default=0)
+    total_attempts_remaining = ndb.FloatProperty(default=0.0)
+    # date of the last reminder email run that mailed this user
+    last_reminder = ndb.DateProperty(indexed=False)
+
+    @classmethod
+    def get_by_name(cls, name):
+        """Returns the User with the given name, or None if there is none"""
+        user = ndb.Key(cls, name).get()
+        if not user and DUAL_READ_NUMERIC_USER_KEYS:
+            user = cls.query(cls.name == name).get()
+        return user
+
+    @classmethod
+    def get_by_names(cls, names):
+        """Returns a list of the Users with the given names, with None for
+        names that have no User. Looks them all up with one get_multi"""
+        users = ndb.get_multi([ndb.Key(cls, name) for name in names])
+        if not DUAL_READ_NUMERIC_USER_KEYS:
+            return users
+        return [user or cls.query(cls.name == name).get()
+                for name, user in zip(names, users)]
+
+    @classmethod
+    def create(cls, name, email=None):
+        """Creates and returns a new User keyed by name. Returns None if a
+        User with that name already exists"""
+        if (DUAL_READ_NUMERIC_USER_KEYS and
+                cls.query(cls.name == name).get(keys_only=True)):
+            return None
+
+        @ndb.transactional
+        def _insert():
+            key = ndb.Key(cls, name)
+            if key.get():
+                return None
+            user = cls(key=key, name=name, email=email)
+            user.put()
+            return user
+        return _insert()
+
+    def record_score(self, won, attempts_remaining):
+        """Adds a finished game to the running aggregates and updates the
+        derived wins and avg_attempts_remaining values used for ranking"""
+        self.games_played += 1
+        if won:
+            self.games_won += 1
+        self.total_attempts_remaining += attempts_remaining
+        self.update_ratios()
+
+    def update_ratios(self):
+        """Recomputes wins and avg_attempts_remaining from the aggregates"""
+        if self.games_played:
+            self.wins = self.games_won / self.games_played
+            self.avg_attempts_remaining = \
+                self.total_attempts_remaining / self.games_played
 
     def rank_to_form(self):
         """Returns a UserRankForm representation of user rank"""
@@ -43,47 +153,96 @@ class Game(ndb.Model):
     attempts_remaining = ndb.IntegerProperty(required=True)
     game_over = ndb.BooleanProperty(required=True, default=False)
     user = ndb.KeyProperty(required=True, kind='User')
+    user_name = ndb.StringProperty(indexed=False)
+    # compact guess history: every guess in order, a bitmask of the letters
+    # guessed and the whole word guesses, so checking for a repeated guess
+    # does not decode the history
+    guesses = ndb.StringProperty(repeated=True, indexed=False)
+    guessed_letters = ndb.IntegerProperty(default=0, indexed=False)
+    word_guesses = ndb.StringProperty(repeated=True, indexed=False)
+    # bumped on every change, for conditional reads
+    version = ndb.IntegerProperty(default=0, indexed=False)
+    # when the game finished, indexed so the compaction job only reads the
+    # games it archives
+    ended = ndb.DateTimeProperty()
+    # results of the latest moves sent with an idempotency key, as
+    # [request_id, [result, ...]] pairs, oldest first. Best-effort: moves
+    # on an active game only reach the datastore with the write-behind
+    receipts = ndb.JsonProperty(indexed=False)
+    # legacy JSON history, converted to guesses by _upgrade_history
     all_results = ndb.StringProperty(repeated=True)
     reveal = ndb.StringProperty(repeated=True)
 
+    # not saved: the version this copy had before its first guess, which
+    # end_game checks the stored game has not moved past, and a callable
+    # that gamecache sets to claim its cached copy before end_game saves
+    _base_version = None
+    _claim_finish = None
+
+    @classmethod
+    def new_game(cls, user, number_of_letters, attempts, difficulty=None):
+        """Creates and returns a new game for the given User"""
+        return cls.new_games([user], number_of_letters, attempts,
+                             difficulty)[0]
+
     @classmethod
-    def new_game(cls, user, number_of_letters, attempts):
-        """Creates and returns a new game"""
+    def new_games(cls, users, number_of_letters, attempts, difficulty=None):
+        """Creates and returns a new game for each of the given Users. The
+        games are saved with one put_multi and one counter update"""
         if not attempts > 0:
             raise ValueError('Number of attempts must be a positive number.')
-        if number_of_letters not in ALLOWED_NUM_OF_LETTERS:
-            raise ValueError('Number of letters can only be 5, 6, or 7!')
-
-        # choose a random word based on the number of letters specified
-        if number_of_letters == 5:
-            words = FIVE_LETTER_WORDS
-        elif number_of_letters == 6:
-            words = SIX_LETTER_WORDS
-        else:
-            words = SEVEN_LETTER_WORDS
-
-        word = random.choice(words)
-        # construct the initial blank state of reveal
-        reveal = []
-        for x in range(0, number_of_letters):
-            reveal.append('')
-
-        game = Game(user=user,
-                    word=random.choice(words),
-                    attempts_allowed=attempts,
-                    attempts_remaining=attempts,
-                    game_over=False,
-                    reveal=reveal)
-        game.put()
-        return game
+        store = words.get_store()
+        allowed = store.lengths()
+        if number_of_letters not in allowed:
+            raise ValueError('Number of letters must be between {} and {}!'
+                             .format(allowed[0], allowed[-1]))
+        if difficulty is not None and difficulty not in words.DIFFICULTIES:
+            raise ValueError('Difficulty can only be {}!'.format(
+                ', '.join(words.DIFFICULTIES)))
+
+        games = []
+        for user in users:
+            # choose a random word based on the number of letters specified
+            word = store.random_word(number_of_letters, difficulty)
+            # construct the initial blank state of reveal
+            reveal = [''] * number_of_letters
+            games.append(Game(parent=user.key,
+                              user=user.key,
+                              user_name=user.name,
+                              word=word,
+                              attempts_allowed=attempts,
+                              attempts_remaining=attempts,
+                              game_over=False,
+                              reveal=reveal))
+        ndb.put_multi(games)
+        counters.increment({
+            counters.ACTIVE_GAMES: len(games),
+            counters.ACTIVE_ATTEMPTS_REMAINING: attempts * len(games)})
+        return games
 
-    def to_form(self, result={}):
+    @classmethod
+    def query_for_user(cls, user_key):
+        """Returns a query for all of a User's Games"""
+        if DUAL_READ_ROOT_ENTITIES:
+            return cls.query(cls.user == user_key)
+        return cls.query(ancestor=user_key)
+
+    @classmethod
+    def to_forms(cls, games):
+        """Returns a GameForms representation of a list of Games, resolving
+        their user names in a single batch"""
+        names = get_user_names(games)
+        return GameForms(items=[game.to_form(user_name=names.get(game.user))
+                                for game in games])
+
+    def to_form(self, result={}, user_name=None):
         """Returns a GameForm representation of the Game"""
         form = GameForm()
         form.urlsafe_key = self.key.urlsafe()
-        form.user_name = self.user.get().name
+        form.user_name = user_name or get_user_names([self])[self.user]
         form.attempts_remaining = self.attempts_remaining
         form.game_over = self.game_over
+        form.etag = self.etag()
         # when the user first creates a new game, show the initial
         # blank state of reveal in its own field
         if not result:
@@ -96,6 +255,10 @@ class Game(ndb.Model):
 
         return form
 
+    def etag(self):
+        """Returns the ETag of the game's current state"""
+        return game_etag(self.version)
+
     @classmethod
     def result_to_form(cls, result):
         """Returns a GuessResultForm representation of guess results"""
@@ -106,65 +269,291 @@ class Game(ndb.Model):
 
         return result_form
 
+    def _upgrade_history(self):
+        """Converts a history stored in the legacy all_results JSON format
+        to the compact guess encoding. Saved with the next put"""
+        if self.all_results and not self.guesses:
+            for result in self.all_results:
+                self._record_guess(json.loads(result)['guess'])
+            self.all_results = []
+
+    def _record_guess(self, guess):
+        self.guesses.append(guess)
+        if len(guess) == 1:
+            self.guessed_letters |= LETTER_BITS[guess]
+        else:
+            self.word_guesses.append(guess)
+
+    def has_guessed(self, guess):
+        """Returns True if guess has already been made in this game"""
+        self._upgrade_history()
+        if len(guess) == 1:
+            return bool(self.guessed_letters & LETTER_BITS[guess])
+        return guess in self.word_guesses
+
+    def hint(self):
+        """Returns a tuple of the suggested next guess, worked out from the
+        reveal and the guesses made so far rather than the word, and the
+        number of dictionary words that still fit the game"""
+        self._upgrade_history()
+        guessed_letters = set(letter for letter, bit in LETTER_BITS.items()
+                              if self.guessed_letters & bit)
+        return words.get_store().best_guess(self.reveal, guessed_letters,
+                                            self.word_guesses)
+
+    def receipt(self, request_id):
+        """Returns the results stored for an idempotency key, or None"""
+        for key, results in self.receipts or []:
+            if key == request_id:
+                return results
+        return None
+
+    def _add_receipt(self, request_id, result):
+        receipts = list(self.receipts or [])
+        if receipts and receipts[-1][0] == request_id:
+            receipts[-1] = [request_id, receipts[-1][1] + [result]]
+        else:
+            receipts = (receipts + [[request_id, [result]]])[-MAX_RECEIPTS:]
+        self.receipts = receipts
+
+    def make_guess(self, guess, request_id=None):
+        """Applies a guess to the game and returns its result. Raises a
+        ValueError if the guess is not valid. A guess that ends the game is
+        saved by end_game; otherwise the caller saves the game and counts
+        a miss against the active attempts counter. If request_id is given,
+        the result is added to its receipt"""
+        # format the guess correctly before using it for matching
+        guess = guess.strip().lower()
+
+        # make sure the guess does not contain any special characters
+        if not guess or not all(letter in LETTER_BITS for letter in guess):
+            raise ValueError('Your guess can only contain alphabet letters.')
+        # make sure the guess is of an appropriate length
+        if len(guess) not in (1, len(self.word)):
+            raise ValueError('Your guess must either be a single letter, '
+                             'or a guess for the entire word.')
+        # make sure the user has not guessed this already
+        if self.has_guessed(guess):
+            raise ValueError('You already guessed that!')
+
+        if self._base_version is None:
+            self._base_version = self.version
+        self._record_guess(guess)
+        self.version += 1
+        result = {'guess': guess, 'hit': guess in self.word}
+        if result['hit']:
+            for pos, letter in enumerate(self.word):
+                if letter == guess:
+                    self.reveal[pos] = guess
+        else:
+            self.attempts_remaining -= 1
+
+        # the receipt is complete before end_game saves the game
+        won = guess == self.word
+        lost = not won and self.attempts_remaining < 1
+        result['word'] = list(self.word if won or lost else self.reveal)
+        if request_id:
+            self._add_receipt(request_id, result)
+
+        # if the user guesses the whole word right, they win.  if the user
+        # has no more attempts remaining, they lose
+        if won:
+            self.end_game(True)
+        elif lost:
+            # the last miss is counted by end_game's counter update
+            self.end_game(False, uncounted_misses=1)
+        return result
+
+    def history(self):
+        """Returns the result of every guess in order. Each step's reveal is
+        rebuilt from the guess list rather than stored"""
+        self._upgrade_history()
+        reveal = [''] * len(self.word)
+        results = []
+        for guess in self.guesses:
+            hit = guess in self.word
+            if hit:
+                for pos, letter in enumerate(self.word):
+                    if letter == guess:
+                        reveal[pos] = guess
+            results.append({'guess': guess, 'hit': hit, 'word': list(reveal)})
+        # the guess that ended the game revealed the whole word
+        if self.game_over and results:
+            results[-1]['word'] = list(self.word)
+        return results
+
     def show_reveal(self):
         """When a game ends, reveal the word"""
         for x in range(0, len(self.word)):
             self.reveal[x] = self.word[x]
 
-    def end_game(self, won=False):
+    def end_game(self, won=False, uncounted_misses=0):
         """Ends the game - if won is True, the player won.
         if won is False, the player lost.  Adds a new score to the
         scoreboard.  Updates the user's wins and avg_attempts_remaining
-        attributes, for ranking purposes."""
+        attributes, for ranking purposes.  Puts the game."""
+        self.end_game_async(won, uncounted_misses).get_result()
+
+    @ndb.tasklet
+    def end_game_async(self, won=False, uncounted_misses=0):
+        """Tasklet version of end_game. The game, its score and the user are
+        written in one transaction, then the leaderboards and counters are
+        updated concurrently. uncounted_misses is the number of misses not
+        yet subtracted from the active attempts counter. Raises
+        GameConflictError, without saving anything, if the stored game has
+        been cancelled, has already finished or has been saved past the
+        version this copy started from, so two concurrent finishing moves
+        cannot record two Scores"""
+        base_version = self._base_version
+        if base_version is None:
+            base_version = self.version
         self.game_over = True
+        self.version += 1
+        self.ended = datetime.now()
         self.show_reveal()
+        if self._claim_finish:
+            self._claim_finish(self)
 
-        self.put()
         # convert attempts_remaining to a ratio presented as a decimal value
         attempts_remaining = self.attempts_remaining / self.attempts_allowed
-        score = Score(user=self.user, date=date.today(), won=won,
+        score = Score(parent=self.user, user=self.user,
+                      user_name=self.user_name,
+                      date=date.today(), won=won,
                       attempts_remaining=attempts_remaining,
                       number_of_letters=len(self.word))
 
-        user = self.user.get()
-        # get all games already played/won, and update the values accordingly
-        prev_games_played = Score.query(Score.user == user.key)
-        prev_games_won = prev_games_played.filter(Score.won == True)  # noqa
-        games_played = prev_games_played.count() + 1
-        games_won = prev_games_won.count()
-        if won:
-            games_won = prev_games_won.count() + 1
-        # update the user's ratio of wins as a decimal value
-        user.wins = games_won / games_played
-
-        all_attempts_remaining = []
-        # add the current and all previous attempts_remaining to a list
-        for game in prev_games_played:
-            all_attempts_remaining.append(game.attempts_remaining)
-        all_attempts_remaining.append(attempts_remaining)
-        # update the average number of attempts_remaining over all games.
-        user.avg_attempts_remaining = \
-            sum(all_attempts_remaining) / games_played
+        @ndb.tasklet
+        def _record():
+            # update the user's running aggregates and stats rollups
+            # together with the score
+            stored, user, rollups = yield (self.key.get_async(),
+                                           self.user.get_async(),
+                                           stats.user_rollups_async(score))
+            if (not stored or stored.game_over or
+                    stored.version > base_version):
+                raise GameConflictError('The game was changed concurrently.')
+            previous_wins = user.wins
+            user.record_score(won, attempts_remaining)
+            score.user_name = user.name
+            yield ndb.put_multi_async([self, score, user] + rollups)
+            raise ndb.Return((user, previous_wins))
+        # games created under their user finish in a single entity group
+        # transaction; games that still need migrating span three groups
+        user, previous_wins = yield ndb.transaction_async(
+            _record, xg=self.key.parent() != self.user)
+
+        yield (leaderboard.record_score_async(score),
+               leaderboard.record_user_async(user, previous_wins),
+               stats.record_global_async(score),
+               counters.increment_async({
+                   counters.ACTIVE_GAMES: -1,
+                   counters.ACTIVE_ATTEMPTS_REMAINING:
+                       -(self.attempts_remaining + uncounted_misses)}))
+
+
+class GameArchive(ndb.Model):
+    """Compact copy of a finished Game, moved out of the Game kind by the
+    compaction job. Keyed with the same parent and id as the Game it
+    replaces, so it can be found from the Game's old urlsafe key. Nothing
+    is indexed, since archived games are only read by key"""
+    user = ndb.KeyProperty(required=True, kind='User', indexed=False)
+    user_name = ndb.StringProperty(indexed=False)
+    word = ndb.StringProperty(required=True, indexed=False)
+    # every guess in order, separated by commas
+    guesses = ndb.StringProperty(indexed=False)
+    attempts_allowed = ndb.IntegerProperty(required=True, indexed=False)
+    attempts_remaining = ndb.IntegerProperty(required=True, indexed=False)
+    won = ndb.BooleanProperty(required=True, indexed=False)
+    version = ndb.IntegerProperty(default=0, indexed=False)
+    ended = ndb.DateTimeProperty(indexed=False)
+
+    @staticmethod
+    def key_for(game_key):
+        """Returns the GameArchive key for a Game key"""
+        return ndb.Key(GameArchive, game_key.id(), parent=game_key.parent())
 
-        score.put()
-        user.put()
+    @classmethod
+    def from_game(cls, game):
+        """Returns an unsaved GameArchive of a finished Game"""
+        game._upgrade_history()
+        return cls(key=cls.key_for(game.key),
+                   user=game.user,
+                   user_name=game.user_name,
+                   word=game.word,
+                   guesses=','.join(game.guesses),
+                   attempts_allowed=game.attempts_allowed,
+                   attempts_remaining=game.attempts_remaining,
+                   won=game.word in game.guesses,
+                   version=game.version,
+                   ended=game.ended)
+
+    def to_game(self):
+        """Returns an unsaved Game with the archived game's key and final
+        state, for read endpoints that resolve archived games"""
+        game_key = ndb.Key(Game, self.key.id(), parent=self.key.parent())
+        game = Game(key=game_key,
+                    user=self.user,
+                    user_name=self.user_name,
+                    word=self.word,
+                    attempts_allowed=self.attempts_allowed,
+                    attempts_remaining=self.attempts_remaining,
+                    game_over=True,
+                    version=self.version,
+                    ended=self.ended,
+                    reveal=list(self.word))
+        for guess in self.guesses.split(',') if self.guesses else []:
+            game._record_guess(guess)
+        return game
 
 
 class Score(ndb.Model):
     """Score object"""
     user = ndb.KeyProperty(required=True, kind='User')
+    user_name = ndb.StringProperty(indexed=False)
     date = ndb.DateProperty(required=True)
     won = ndb.BooleanProperty(required=True)
     attempts_remaining = ndb.FloatProperty(required=True)
     number_of_letters = ndb.IntegerProperty(required=True)
 
-    def to_form(self):
-        return ScoreForm(user_name=self.user.get().name, won=self.won,
+    @classmethod
+    def to_forms(cls, scores):
+        """Returns a ScoreForms representation of a list of Scores, resolving
+        their user names in a single batch"""
+        names = get_user_names(scores)
+        return ScoreForms(items=[score.to_form(user_name=names.get(score.user))
+                                 for score in scores])
+
+    @classmethod
+    def query_for_user(cls, user_key):
+        """Returns a query for all of a User's Scores"""
+        if DUAL_READ_ROOT_ENTITIES:
+            return cls.query(cls.user == user_key)
+        return cls.query(ancestor=user_key)
+
+    def to_form(self, user_name=None):
+        user_name = user_name or get_user_names([self])[self.user]
+        return ScoreForm(user_name=user_name, won=self.won,
                          date=str(self.date),
                          number_of_letters=self.number_of_letters,
                          attempts_remaining=self.attempts_remaining)
 
 
+class GameRedirect(ndb.Model):
+    """Points the key of a Game moved under its User to the new key, so
+    urlsafe keys handed out before the move keep working. Keyed by the old
+    key's urlsafe string"""
+    target = ndb.KeyProperty(required=True, kind='Game', indexed=False)
+
+
+class ReminderRun(ndb.Model):
+    """Progress of one day's reminder emails. The cursor is checkpointed
+    after each batch so a killed run resumes where it stopped"""
+    cursor = ndb.StringProperty(indexed=False)
+    batches = ndb.IntegerProperty(default=0, indexed=False)
+    done = ndb.BooleanProperty(default=False, indexed=False)
+    started = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+
 class GuessResultForm(messages.Message):
     """GuessResultForm to be used for outbound game state information"""
     guess = messages.StringField(1)
@@ -175,16 +564,21 @@ class GuessResultForm(messages.Message):
 class GuessResultForms(messages.Message):
     """Return multiple GuessResultForms"""
     items = messages.MessageField(GuessResultForm, 1, repeated=True)
+    etag = messages.StringField(2)
+    not_modified = messages.BooleanField(3)
 
 
 class GameForm(messages.Message):
-    """GameForm for outbound game state information"""
-    urlsafe_key = messages.StringField(1, required=True)
-    attempts_remaining = messages.IntegerField(2, required=True)
-    game_over = messages.BooleanField(3, required=True)
-    user_name = messages.StringField(5, required=True)
+    """GameForm for outbound game state information. A conditional read of
+    an unchanged game only sets etag and not_modified"""
+    urlsafe_key = messages.StringField(1)
+    attempts_remaining = messages.IntegerField(2)
+    game_over = messages.BooleanField(3)
+    user_name = messages.StringField(5)
     result = messages.MessageField(GuessResultForm, 7)
     word = messages.StringField(8, repeated=True)
+    etag = messages.StringField(9)
+    not_modified = messages.BooleanField(10)
 
 
 class GameForms(messages.Message):
@@ -197,11 +591,34 @@ class NewGameForm(messages.Message):
     user_name = messages.StringField(1, required=True)
     number_of_letters = messages.IntegerField(2, default=6)
     attempts = messages.IntegerField(3, default=6)
+    difficulty = messages.StringField(4)
+
+
+class NewGamesForm(messages.Message):
+    """Used to create a batch of new games"""
+    user_names = messages.StringField(1, repeated=True)
+    games_per_user = messages.IntegerField(2, default=1)
+    number_of_letters = messages.IntegerField(3, default=6)
+    attempts = messages.IntegerField(4, default=6)
+    difficulty = messages.StringField(5)
+
+
+class HintForm(messages.Message):
+    """Suggested next guess for a game"""
+    guess = messages.StringField(1, required=True)
+    candidates = messages.IntegerField(2, required=True)
 
 
 class MakeMoveForm(messages.Message):
     """Used to make a move in an existing game"""
     guess = messages.StringField(1, required=True)
+    request_id = messages.StringField(2)
+
+
+class MakeMovesForm(messages.Message):
+    """Used to make several moves in a row in an existing game"""
+    guesses = messages.StringField(1, repeated=True)
+    request_id = messages.StringField(2)
 
 
 class ScoreForm(messages.Message):
@@ -216,18 +633,48 @@ class ScoreForm(messages.Message):
 class ScoreForms(messages.Message):
     """Return multiple ScoreForms"""
     items = messages.MessageField(ScoreForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
+    etag = messages.StringField(3)
+    not_modified = messages.BooleanField(4)
+
+
+class LengthStatsForm(messages.Message):
+    """Stats of the games with one word length within a StatsForm"""
+    number_of_letters = messages.IntegerField(1, required=True)
+    games_played = messages.IntegerField(2, required=True)
+    games_won = messages.IntegerField(3, required=True)
+    avg_attempts_remaining = messages.FloatField(4, required=True)
+
+
+class StatsForm(messages.Message):
+    """Stats of the games finished in one day or week"""
+    start = messages.StringField(1, required=True)
+    games_played = messages.IntegerField(2, required=True)
+    games_won = messages.IntegerField(3, required=True)
+    win_rate = messages.FloatField(4)
+    avg_attempts_remaining = messages.FloatField(5)
+    by_length = messages.MessageField(LengthStatsForm, 6, repeated=True)
+
+
+class StatsForms(messages.Message):
+    """Return a time series of StatsForms, oldest first"""
+    items = messages.MessageField(StatsForm, 1, repeated=True)
+    period = messages.StringField(2)
 
 
 class UserRankForm(messages.Message):
     """UserRankForm for outbound user rank information"""
     user_name = messages.StringField(1, required=True)
-    wins = messages.FloatField(2, required=True)
-    avg_attempts_remaining = messages.FloatField(3, required=True)
+    # not set, like rank, for users who have not finished a game
+    wins = messages.FloatField(2)
+    avg_attempts_remaining = messages.FloatField(3)
+    rank = messages.IntegerField(4)
 
 
 class UserRankForms(messages.Message):
     """Return multiple UserRankForms"""
     items = messages.MessageField(UserRankForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
 
 
 class StringMessageForm(messages.Message):
@@ -0,0 +1,222 @@
+"""stats.py - Daily and weekly rollups of finished games, per user and for
+all users. Each rollup holds the number of games played and won, the summed
+attempts remaining ratios and the same figures per word length, so a time
+series is read with one batch get instead of scanning Scores.
+
+User rollups are children of their User and are written in the same
+transaction as the Score. Every game ends in the global rollups, so those
+are sharded like counters.py and updated after the transaction. A cron job
+rebuilds the recent rollups from Scores to repair any drift, one batch of
+users per task."""
+
+import random
+from datetime import date, timedelta
+
+from google.appengine.ext import ndb
+
+DAY = 'day'
+WEEK = 'week'
+PERIODS = (DAY, WEEK)
+
+NUM_SHARDS = 10
+MAX_PERIODS = 60
+# the rebuild covers this many days, extended back to the start of a week
+REBUILD_DAYS = 14
+
+
+class StatsRebuild(ndb.Model):
+    """Progress of one rebuild of the recent rollups. The cursor over Users
+    and the global totals of the Scores seen so far are checkpointed after
+    each batch"""
+    today = ndb.DateProperty(indexed=False)
+    cursor = ndb.StringProperty(indexed=False)
+    # maps a rollup id to the StatsRollup.to_dict() of its global totals
+    totals = ndb.JsonProperty(indexed=False)
+    done = ndb.BooleanProperty(default=False, indexed=False)
+    started = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+
+class StatsRollup(ndb.Model):
+    """Totals of the games that finished in one day or week, for one User
+    or one shard of the global totals"""
+    games_played = ndb.IntegerProperty(default=0, indexed=False)
+    games_won = ndb.IntegerProperty(default=0, indexed=False)
+    total_attempts_remaining = ndb.FloatProperty(default=0.0, indexed=False)
+    # maps str(number_of_letters) to [games_played, games_won,
+    # total_attempts_remaining]
+    by_length = ndb.JsonProperty(indexed=False)
+
+    def add(self, won, attempts_remaining, number_of_letters):
+        """Adds one finished game"""
+        self.games_played += 1
+        self.games_won += int(won)
+        self.total_attempts_remaining += attempts_remaining
+        by_length = dict(self.by_length or {})
+        totals = by_length.get(str(number_of_letters), [0, 0, 0.0])
+        by_length[str(number_of_letters)] = [
+            totals[0] + 1, totals[1] + int(won),
+            totals[2] + attempts_remaining]
+        self.by_length = by_length
+
+    def merge(self, other):
+        """Adds another rollup's totals to this one"""
+        self.games_played += other.games_played
+        self.games_won += other.games_won
+        self.total_attempts_remaining += other.total_attempts_remaining
+        by_length = dict(self.by_length or {})
+        for length, totals in (other.by_length or {}).items():
+            mine = by_length.get(length, [0, 0, 0.0])
+            by_length[length] = [a + b for a, b in zip(mine, totals)]
+        self.by_length = by_length
+
+
+def period_start(period, day):
+    """Returns the first day of the day or week (starting Monday) holding
+    the given date"""
+    if period == WEEK:
+        return day - timedelta(days=day.weekday())
+    return day
+
+
+def _step(period):
+    return timedelta(weeks=1) if period == WEEK else timedelta(days=1)
+
+
+def _rollup_id(period, start):
+    return '{}:{}'.format(period, start.isoformat())
+
+
+def _user_key(user_key, period, start):
+    return ndb.Key(StatsRollup, _rollup_id(period, start), parent=user_key)
+
+
+def _global_key(period, start, shard):
+    return ndb.Key(StatsRollup,
+                   'global:{}:{}'.format(_rollup_id(period, start), shard))
+
+
+def _score_keys(score, key_for):
+    return [key_for(period, period_start(period, score.date))
+            for period in PERIODS]
+
+
+@ndb.tasklet
+def user_rollups_async(score):
+    """Returns the User's day and week rollups with a Score added, for the
+    caller to put in the transaction that saves the Score"""
+    keys = _score_keys(
+        score, lambda period, start: _user_key(score.user, period, start))
+    rollups = yield ndb.get_multi_async(keys)
+    rollups = [rollup or StatsRollup(key=key)
+               for key, rollup in zip(keys, rollups)]
+    for rollup in rollups:
+        rollup.add(score.won, score.attempts_remaining,
+                   score.number_of_letters)
+    raise ndb.Return(rollups)
+
+
+@ndb.tasklet
+def record_global_async(score):
+    """Adds a Score to one random shard of the global day and week
+    rollups"""
+    shard = random.randint(0, NUM_SHARDS - 1)
+    keys = _score_keys(
+        score, lambda period, start: _global_key(period, start, shard))
+
+    @ndb.transactional_tasklet(xg=True)
+    def _txn():
+        rollups = yield ndb.get_multi_async(keys)
+        rollups = [rollup or StatsRollup(key=key)
+                   for key, rollup in zip(keys, rollups)]
+        for rollup in rollups:
+            rollup.add(score.won, score.attempts_remaining,
+                       score.number_of_letters)
+        yield ndb.put_multi_async(rollups)
+    yield _txn()
+
+
+def get_series(period, count, user_key=None, today=None):
+    """Returns a list of (start, StatsRollup) for the count periods up to
+    and including the current one, oldest first, read with one get_multi.
+    Periods without games get an empty rollup. Global rollups have their
+    shards summed"""
+    today = today or date.today()
+    start = period_start(period, today)
+    starts = [start - _step(period) * index
+              for index in reversed(range(count))]
+    if user_key:
+        keys = [_user_key(user_key, period, day) for day in starts]
+        shards = 1
+    else:
+        keys = [_global_key(period, day, shard)
+                for day in starts for shard in range(NUM_SHARDS)]
+        shards = NUM_SHARDS
+
+    entities = ndb.get_multi(keys)
+    series = []
+    for index, day in enumerate(starts):
+        rollup = StatsRollup()
+        for entity in entities[index * shards:(index + 1) * shards]:
+            if entity:
+                rollup.merge(entity)
+        series.append((day, rollup))
+    return series
+
+
+def rebuild_start(today=None):
+    """Returns the first date covered by a rebuild, a Monday"""
+    today = today or date.today()
+    return period_start(WEEK, today - timedelta(days=REBUILD_DAYS))
+
+
+def user_rollups(user_key, scores):
+    """Returns a User's rollups recomputed from their Scores dated from
+    rebuild_start() on, for the caller to put in the transaction that read
+    them"""
+    rollups = {}
+    for score in scores:
+        for period in PERIODS:
+            key = _user_key(user_key, period,
+                            period_start(period, score.date))
+            rollup = rollups.setdefault(key, StatsRollup(key=key))
+            rollup.add(score.won, score.attempts_remaining,
+                       score.number_of_letters)
+    return rollups.values()
+
+
+def add_closed_totals(totals, scores, today):
+    """Adds Scores to a dict of global totals by rollup id, as kept on a
+    StatsRebuild, counting only the periods in the rebuild window that
+    ended before today. Returns the dict"""
+    first = rebuild_start(today)
+    for score in scores:
+        if score.date < first:
+            continue
+        for period in PERIODS:
+            start = period_start(period, score.date)
+            if start + _step(period) > today:
+                continue
+            rollup_id = _rollup_id(period, start)
+            rollup = StatsRollup(**totals.get(rollup_id, {}))
+            rollup.add(score.won, score.attempts_remaining,
+                       score.number_of_letters)
+            totals[rollup_id] = rollup.to_dict()
+    return totals
+
+
+def rebuild_global(totals, today):
+    """Rewrites the global rollups of the periods in the rebuild window that
+    ended before today from the totals of a finished StatsRebuild. Every
+    shard is rewritten, so shards drifted away from zero are reset even if
+    the period has no games. Periods still open are left to the
+    incremental updates, which rewriting them could lose"""
+    rollups = []
+    for period in PERIODS:
+        day = rebuild_start(today)
+        while day + _step(period) <= today:
+            values = totals.get(_rollup_id(period, day), {})
+            for shard in range(NUM_SHARDS):
+                rollups.append(StatsRollup(key=_global_key(period, day, shard),
+                                           **(values if shard == 0 else {})))
+            day += _step(period)
+    ndb.put_multi(rollups)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+"""test_gamecache.py - Testbed tests of the compare-and-set, finish claim
+and receipt logic in gamecache.update_game. Concurrent requests are played
+out in order by making one move from inside another's update:
+
+    GAE_SDK=~/google-cloud-sdk/platform/google_appengine \\
+        python test_gamecache.py"""
+
+import os
+import unittest
+from datetime import datetime, timedelta
+
+import benchmark
+
+benchmark._setup_sdk(os.environ.get('GAE_SDK'))
+
+import endpoints  # noqa
+from google.appengine.api import memcache  # noqa
+from google.appengine.ext import ndb  # noqa
+
+import api  # noqa
+import gamecache  # noqa
+from models import Game, Score, User  # noqa
+
+
+class UpdateGameTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bed = benchmark._activate_testbed()
+        ndb.set_context(None)
+        self.service = api.HangmanApi()
+        self.user = User.create('player')
+
+    def tearDown(self):
+        self.bed.deactivate()
+
+    def _new_game(self, word='abc', attempts=3):
+        game = Game(parent=self.user.key, user=self.user.key,
+                    user_name=self.user.name, word=word,
+                    attempts_allowed=attempts, attempts_remaining=attempts,
+                    game_over=False, reveal=[''] * len(word))
+        game.put()
+        return game.key.urlsafe()
+
+    def _move(self, urlsafe, guess, request_id=None):
+        return self.service._make_move(urlsafe, request_id,
+                                       lambda game: guess)
+
+    def _stored(self, urlsafe):
+        return ndb.Key(urlsafe=urlsafe).get(use_cache=False,
+                                            use_memcache=False)
+
+    def test_concurrent_finishing_moves_record_one_score(self):
+        urlsafe = self._new_game(attempts=1)
+        raced = []
+
+        def _guess(game):
+            if not raced:
+                raced.append(True)
+                self._move(urlsafe, 'abc')
+            return 'abc'
+        with self.assertRaises(endpoints.BadRequestException):
+            self.service._make_move(urlsafe, None, _guess)
+        self.assertEqual(1, Score.query().count())
+        self.assertTrue(self._stored(urlsafe).game_over)
+        self.assertIsNone(memcache.get(gamecache.MEMCACHE_GAME.format(
+            urlsafe)))
+
+    def test_move_before_claim_is_kept_by_finish(self):
+        urlsafe = self._new_game()
+        raced = []
+
+        def _guess(game):
+            if not raced:
+                raced.append(True)
+                self._move(urlsafe, 'x')
+            return 'abc'
+        form = self.service._make_move(urlsafe, None, _guess)
+        self.assertTrue(form.game_over)
+        stored = self._stored(urlsafe)
+        self.assertEqual(['x', 'abc'], stored.guesses)
+        self.assertEqual(2, stored.attempts_remaining)
+        scores = Score.query().fetch()
+        self.assertEqual(1, len(scores))
+        self.assertAlmostEqual(2 / 3.0, scores[0].attempts_remaining)
+
+    def test_move_backs_off_while_finish_is_claimed(self):
+        urlsafe = self._new_game()
+        gamecache.get_game(urlsafe)
+        cache_key = gamecache.MEMCACHE_GAME.format(urlsafe)
+        claimed = memcache.get(cache_key)
+        claimed.game_over = True
+        claimed.ended = datetime.now()
+        memcache.set(cache_key, claimed)
+
+        with self.assertRaises(gamecache.ConcurrentMoveError):
+            gamecache.update_game(urlsafe,
+                                  lambda game: game.make_guess('x'))
+        self.assertEqual([], memcache.get(cache_key).guesses)
+
+        # a claim that was never cleared is given up on
+        claimed.ended = datetime.now() - timedelta(
+            seconds=gamecache.FINISH_CLAIM_SECONDS + 1)
+        memcache.set(cache_key, claimed)
+        result, game = gamecache.update_game(
+            urlsafe, lambda game: game.make_guess('x'))
+        self.assertFalse(result['hit'])
+        self.assertFalse(game.game_over)
+        self.assertEqual(['x'], memcache.get(cache_key).guesses)
+
+    def test_replayed_request_id_returns_stored_result(self):
+        urlsafe = self._new_game()
+        first = self._move(urlsafe, 'x', request_id='move-1')
+        replayed = self._move(urlsafe, 'y', request_id='move-1')
+        self.assertEqual(first.result.guess, replayed.result.guess)
+        self.assertEqual(['x'], gamecache.get_game(urlsafe).guesses)
+
+        finished = self._move(urlsafe, 'abc', request_id='move-2')
+        replayed = self._move(urlsafe, 'abc', request_id='move-2')
+        self.assertTrue(finished.game_over)
+        self.assertTrue(replayed.game_over)
+        self.assertEqual('abc', replayed.result.guess)
+        self.assertEqual(1, Score.query().count())
+
+    def test_conflict_reloads_stored_game(self):
+        urlsafe = self._new_game()
+        key = ndb.Key(urlsafe=urlsafe)
+        gamecache.get_game(urlsafe)
+        # this request has the active game in its in-context cache
+        key.get()
+
+        # another request finishes the stored game behind the cache
+        context = ndb.get_context()
+        ndb.set_context(ndb.make_default_context())
+        try:
+            key.get().make_guess('abc')
+        finally:
+            ndb.set_context(context)
+
+        with self.assertRaises(endpoints.BadRequestException):
+            self._move(urlsafe, 'abc')
+        self.assertIsNone(memcache.get(gamecache.MEMCACHE_GAME.format(
+            urlsafe)))
+        self.assertEqual(1, Score.query().count())
+
+
+if __name__ == '__main__':
+    unittest.main()
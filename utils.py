@@ -1,11 +1,21 @@
 """utils.py - File for collecting general utility functions."""
 
 import logging
+from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 import endpoints
 
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
 
-def get_by_urlsafe(urlsafe, model):
+MEMCACHE_MISSING = 'MISSING:'
+MISSING_CACHE_SECONDS = 60
+
+
+def get_by_urlsafe(urlsafe, model, use_cache=True, use_memcache=True,
+                   cache_missing=False, resolve=None):
     """Returns an ndb.Model entity that the urlsafe key points to. Checks
         that the type of entity returned is of the correct kind. Raises an
         error if the key String is malformed or the entity is of the incorrect
@@ -13,11 +23,60 @@ def get_by_urlsafe(urlsafe, model):
     Args:
         urlsafe: A urlsafe key string
         model: The expected entity kind
+        use_cache: Whether to use the ndb in-context cache
+        use_memcache: Whether to use the ndb memcache cache
+        cache_missing: Whether to remember, for MISSING_CACHE_SECONDS, that
+            no entity exists, so repeated lookups skip the datastore
+        resolve: Optional function called with the Key of an entity that
+            does not exist, returning an entity found another way or None
     Returns:
         The entity that the urlsafe Key string points to or None if no entity
         exists.
     Raises:
         ValueError:"""
+    return get_multi_by_urlsafe([urlsafe], model, use_cache=use_cache,
+                                use_memcache=use_memcache,
+                                cache_missing=cache_missing,
+                                resolve=resolve)[0]
+
+
+def get_multi_by_urlsafe(urlsafes, model, use_cache=True, use_memcache=True,
+                         cache_missing=False, resolve=None):
+    """Batch version of get_by_urlsafe. Returns a list of the entities that
+    the urlsafe keys point to, with None for keys that have no entity,
+    fetched with a single get_multi"""
+    keys = [_decode_key(urlsafe) for urlsafe in urlsafes]
+    missing = get_missing(urlsafes) if cache_missing else set()
+    lookup = [key for urlsafe, key in zip(urlsafes, keys)
+              if urlsafe not in missing]
+    found = dict(zip(lookup, ndb.get_multi(lookup, use_cache=use_cache,
+                                           use_memcache=use_memcache)))
+    if resolve:
+        for key in lookup:
+            if found[key] is None:
+                found[key] = resolve(key)
+
+    entities = [found.get(key) for key in keys]
+    for entity in entities:
+        if entity and not isinstance(entity, model):
+            raise ValueError('Incorrect Kind')
+    if cache_missing:
+        mark_missing([urlsafe for urlsafe, key in zip(urlsafes, keys)
+                      if key in found and found[key] is None])
+    return entities
+
+
+def _decode_key(urlsafe):
+    """Returns the ndb.Key for a urlsafe string, decoding each string once
+    per request. The keys are kept on the ndb context, which ndb starts
+    afresh for every request"""
+    context = ndb.get_context()
+    decoded = getattr(context, '_decoded_keys', None)
+    if decoded is None:
+        decoded = context._decoded_keys = {}
+    key = decoded.get(urlsafe)
+    if key is not None:
+        return key
     try:
         key = ndb.Key(urlsafe=urlsafe)
     except TypeError:
@@ -27,10 +86,68 @@ def get_by_urlsafe(urlsafe, model):
             raise endpoints.BadRequestException('Invalid Key')
         else:
             raise
+    decoded[urlsafe] = key
+    return key
+
+
+def get_missing(urlsafes):
+    """Returns the set of the urlsafe keys recently found to have no
+    entity"""
+    cached = memcache.get_multi(urlsafes, key_prefix=MEMCACHE_MISSING)
+    return set(cached)
+
+
+def mark_missing(urlsafes):
+    """Remembers that the urlsafe keys have no entity, for example once a
+    game is cancelled"""
+    if urlsafes:
+        memcache.set_multi(dict.fromkeys(urlsafes, True),
+                           key_prefix=MEMCACHE_MISSING,
+                           time=MISSING_CACHE_SECONDS)
 
-    entity = key.get()
-    if not entity:
-        return None
-    if not isinstance(entity, model):
-        raise ValueError('Incorrect Kind')
-    return entity
+
+def page_size(limit=None):
+    """Returns the bounded page size for a requested limit. Defaults to
+    DEFAULT_PAGE_SIZE and is capped at MAX_PAGE_SIZE. Raises
+    endpoints.BadRequestException if the limit is not positive"""
+    limit = DEFAULT_PAGE_SIZE if limit is None else limit
+    if limit < 1:
+        raise endpoints.BadRequestException('Limit must be a positive number.')
+    return min(limit, MAX_PAGE_SIZE)
+
+
+def fetch_page(query, limit=None, urlsafe_cursor=None, offset=0):
+    """Fetches one bounded page of a query.
+    Args:
+        query: The ndb.Query to page through
+        limit: The requested page size, bounded by page_size
+        urlsafe_cursor: The urlsafe cursor returned with the previous page,
+            or None for the first page
+        offset: Number of results to skip before the page starts
+    Returns:
+        A tuple of the entities on the page and the urlsafe cursor for the
+        next page, or None if there are no more results.
+    Raises:
+        endpoints.BadRequestException: if the limit or cursor is invalid"""
+    limit = page_size(limit)
+    try:
+        cursor = Cursor(urlsafe=urlsafe_cursor) if urlsafe_cursor else None
+    except datastore_errors.BadValueError:
+        raise endpoints.BadRequestException('Invalid cursor')
+
+    entities, next_cursor, more = query.fetch_page(limit, start_cursor=cursor,
+                                                   offset=offset)
+    if more and next_cursor:
+        return entities, next_cursor.urlsafe()
+    return entities, None
+
+
+def not_modified(request_state, etag):
+    """Returns whether the request's If-None-Match header matches etag.
+    Endpoints cannot send a 304, so callers answer with a form that only
+    carries the etag and not_modified=True.
+    Args:
+        request_state: The endpoints request_state of the current request
+        etag: The current ETag of the requested resource, or None if it
+            cannot be answered conditionally"""
+    return bool(etag) and request_state.headers.get('If-None-Match') == etag
@@ -0,0 +1,199 @@
+"""words.py - Length-indexed word dictionary used to pick target words and
+to suggest guesses.
+
+The word file lists one word per line, most common words first. Words of
+each length are packed end to end into a single byte string, so a word is
+found from its index alone and the store holds one object per length rather
+than one Python string per word. The store is loaded lazily, once per
+instance, the first time a word is needed.
+
+For hints, each length also gets a lazily built index of bitsets over its
+word indexes: one per position and letter, and one per letter for words
+containing it anywhere. The words that fit a game are then found with a few
+bitwise operations rather than by scanning the word list."""
+
+import binascii
+import os
+import random
+import string
+import threading
+
+WORDS_FILE = os.path.join(os.path.dirname(__file__), 'words.txt')
+MIN_WORD_LENGTH = 4
+
+# difficulty tiers split each length's words by frequency rank, so 'easy'
+# words are the most common third and 'hard' words the least common third
+DIFFICULTIES = ('easy', 'medium', 'hard')
+
+# letters in rough order of how often they appear in English words, used to
+# break ties between suggested letters
+LETTER_FREQUENCY = 'etaoinsrhldcumfpgwybvkxjqz'
+
+_LETTERS = frozenset(string.ascii_lowercase)
+
+
+class WordStore(object):
+    """Words grouped by length and packed into one byte string per length"""
+
+    def __init__(self, words):
+        """Builds the store from an iterable of words, most common first"""
+        buffers = {}
+        for word in words:
+            buffers.setdefault(len(word), bytearray()).extend(word)
+        self._packed = dict((length, bytes(buffer))
+                            for length, buffer in buffers.items())
+        self._indexes = {}
+        self._index_lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, path):
+        """Loads a store from a word file, skipping words that are too short
+        or contain anything other than the letters a-z"""
+        def _words():
+            with open(path) as word_file:
+                for line in word_file:
+                    word = line.strip().lower()
+                    if (len(word) >= MIN_WORD_LENGTH and
+                            _LETTERS.issuperset(word)):
+                        yield word
+        return cls(_words())
+
+    def lengths(self):
+        """Returns the word lengths that can be played, in ascending order.
+        A length is playable when every difficulty tier has a word"""
+        return sorted(length for length in self._packed
+                      if self.count(length) >= len(DIFFICULTIES))
+
+    def count(self, length):
+        """Returns the number of words with the given length"""
+        return len(self._packed.get(length, '')) // length
+
+    def word(self, length, index):
+        """Returns the index'th most common word with the given length"""
+        start = index * length
+        return self._packed[length][start:start + length]
+
+    def random_word(self, length, difficulty=None):
+        """Returns a random word with the given length, optionally limited
+        to one difficulty tier"""
+        count = self.count(length)
+        if difficulty is None:
+            return self.word(length, random.randrange(count))
+        tier = DIFFICULTIES.index(difficulty)
+        start = count * tier // len(DIFFICULTIES)
+        end = count * (tier + 1) // len(DIFFICULTIES)
+        return self.word(length, random.randrange(start, end))
+
+    def build_indexes(self):
+        """Builds the hint index of every playable length up front, for
+        instance warmup"""
+        for length in self.lengths():
+            self._index(length)
+
+    def _index(self, length):
+        """Returns the position and letter bitsets of the words with the
+        given length, building them on first use. Bit i of a bitset is set
+        if word i has the letter there"""
+        index = self._indexes.get(length)
+        if index is None:
+            with self._index_lock:
+                index = self._indexes.get(length)
+                if index is None:
+                    index = self._indexes[length] = self._build_index(length)
+        return index
+
+    def _build_index(self, length):
+        count = self.count(length)
+        packed = self._packed.get(length, '')
+        # set bits in byte arrays, then convert each to one int
+        bitmaps = [{} for _ in range(length)]
+        for start in range(0, count * length, length):
+            byte, bit = divmod(start // length, 8)
+            for position in range(length):
+                bitmap = bitmaps[position].get(packed[start + position])
+                if bitmap is None:
+                    bitmap = bitmaps[position][packed[start + position]] = \
+                        bytearray(count // 8 + 1)
+                bitmap[byte] |= 1 << bit
+        positions = [dict((letter, _to_int(bitmap))
+                          for letter, bitmap in letters.items())
+                     for letters in bitmaps]
+        contains = {}
+        for letters in positions:
+            for letter, bits in letters.items():
+                contains[letter] = contains.get(letter, 0) | bits
+        return positions, contains
+
+    def candidates(self, reveal, guessed_letters, word_guesses=()):
+        """Returns a bitset of the words that fit a game's reveal, a list
+        of the revealed letter or '' for each position, given the letters
+        and whole words already guessed"""
+        length = len(reveal)
+        positions, contains = self._index(length)
+        mask = (1 << self.count(length)) - 1
+        for position, letter in enumerate(reveal):
+            if letter:
+                mask &= positions[position].get(letter, 0)
+        for letter in guessed_letters:
+            if letter in reveal:
+                # a hit reveals every position holding the letter
+                for position, revealed in enumerate(reveal):
+                    if not revealed:
+                        mask &= ~positions[position].get(letter, 0)
+            else:
+                mask &= ~contains.get(letter, 0)
+        for word in word_guesses:
+            index = self._find(word)
+            if index is not None:
+                mask &= ~(1 << index)
+        return mask
+
+    def _find(self, word):
+        """Returns the index of a word in the store, or None"""
+        packed = self._packed.get(len(word), '')
+        start = packed.find(word)
+        while start != -1 and start % len(word):
+            start = packed.find(word, start + 1)
+        return None if start == -1 else start // len(word)
+
+    def best_guess(self, reveal, guessed_letters, word_guesses=()):
+        """Returns a tuple of the suggested next guess for a game and the
+        number of words that still fit it. The guess is the word itself
+        when only one fits, and otherwise the unguessed letter found in the
+        most of them. It is None if every letter has been guessed"""
+        mask = self.candidates(reveal, guessed_letters, word_guesses)
+        remaining = _popcount(mask)
+        if remaining == 1:
+            return self.word(len(reveal), mask.bit_length() - 1), remaining
+        _, contains = self._index(len(reveal))
+        best, best_count = None, -1
+        for letter in LETTER_FREQUENCY:
+            if letter in guessed_letters:
+                continue
+            count = _popcount(mask & contains.get(letter, 0))
+            if count > best_count:
+                best, best_count = letter, count
+        return best, remaining
+
+
+def _to_int(bitmap):
+    """Converts a little-endian bitmap to an int"""
+    return int(binascii.hexlify(bytes(bitmap[::-1])) or '0', 16)
+
+
+def _popcount(bits):
+    return bin(bits).count('1')
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """Returns this instance's WordStore, loading it on first use"""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = WordStore.from_file(WORDS_FILE)
+    return _store